@@ -34,39 +34,18 @@ Options:
 import logging
 import sys
 import os
-from pkgutil import iter_modules
+from importlib.util import find_spec
 
-import coloredlogs
 from docopt import docopt
 
 import ledd.daemon
 import ledd
 
-if "smbus" not in (name for loader, name, ispkg in iter_modules()):
+# a direct lookup, scanning all of sys.path takes seconds on slow SD cards
+if find_spec("smbus") is None:
     print("smbus not found, installing replacement")
-
-
-    class SMBus:
-        def __init__(self, i2c_address):
-            self.i2c_address = i2c_address
-            self.channels = {}
-
-        def write_word_data(self, addr, cmd, val):
-            if (cmd - 6) % 4 == 0:
-                self.channels[(cmd - 6) // 4] = val
-
-        def read_word_data(self, addr, cmd):
-            if (cmd - 8) // 4 not in self.channels:
-                self.channels[(cmd - 8) // 4] = 0
-            return self.channels[(cmd - 8) // 4]
-
-
-    class SMBusModule:
-        SMBus = SMBus
-
-
-    sys.modules['smbus'] = SMBusModule
-    sys.modules['smbus'].SMBus = SMBus
+    import ledd.simbus
+    ledd.simbus.install()
 
 
 def pid_exists(processid):
@@ -93,6 +72,8 @@ if __name__ == "__main__":
         lvl = logging.DEBUG
 
     log = logging.getLogger(__name__)
+    # only needed when started from the command line
+    import coloredlogs
     coloredlogs.install(level=lvl)
 
     try:
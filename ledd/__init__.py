@@ -21,7 +21,8 @@ from sqlalchemy.ext.declarative import declarative_base
 VERSION = "0.1"
 
 engine = None
-session = scoped_session(sessionmaker())
+# objects outlive the commits of the db thread, reloading them would touch the database from the event loop
+session = scoped_session(sessionmaker(expire_on_commit=False))
 """ :type : sqlalchemy.orm.scoping.scoped_session """
 Base = declarative_base()
 Base.query = session.query_property()
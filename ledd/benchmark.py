@@ -0,0 +1,268 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""LedD Benchmark
+
+Renders and flushes frames as fast as possible on simulated PCA9685 controllers and prints the results as JSON.
+With startup, measures the time from starting ledd.py until the first RPC is answered instead.
+Run as python -m ledd.benchmark.
+
+Usage:
+  benchmark [options]
+  benchmark startup [--runs=<n>] [--port=<port>] [--importtime] [--output=<file>]
+  benchmark -h | --help
+
+Options:
+  -h --help               Show this screen.
+  --controllers=<n,..>    Controller counts to benchmark [default: 1,4].
+  --stripes=<n,..>        Stripes per controller to benchmark, at most 5 [default: 1,5].
+  --effects=<name,..>     Effects to benchmark, fade or cycle [default: fade,cycle].
+  --frames=<n>            Frames per run [default: 500].
+  --latency=<s>           Simulated time per I2C transaction [default: 0.0001].
+  --byte-time=<s>         Simulated time per transferred byte, 400 kHz take 0.0000225 [default: 0.0000225].
+  --output=<file>         Write the results to a file instead of stdout.
+  --runs=<n>              Daemon starts to measure [default: 5].
+  --port=<port>           Port the started daemons listen on [default: 14250].
+  --importtime            Also report the slowest imports of ledd.daemon, measured with python -X importtime.
+"""
+
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+from . import simbus
+
+# the simulated smbus module has to be registered before any of the imports below can import smbus
+simbus.install()
+
+import ledd.stripe  # noqa: E402, registers the Stripe mapper used by Controller
+from ledd.color import HSV  # noqa: E402
+from ledd.controller import Controller  # noqa: E402
+from ledd.effects.fadeeffect import FadeEffect  # noqa: E402
+from ledd.effects.generatoreffect import GeneratorEffect  # noqa: E402
+from ledd.effectstack import EffectStack  # noqa: E402
+from ledd.scheduler import FrameScheduler  # noqa: E402
+from ledd.stripe import Stripe  # noqa: E402
+
+
+class CycleEffect(GeneratorEffect):
+    """
+    Worst case for the bus: jumps around the color wheel, so every channel changes with every frame.
+    """
+    name = "Cycle Effect"
+    color_space = HSV
+
+    def execute(self):
+        i = 0
+        while True:
+            yield i * 7.0 % 360, 1.0, 0.5 + i % 2 * 0.25
+            i += 1
+
+
+EFFECTS = {
+    'fade': FadeEffect,
+    'cycle': CycleEffect
+}
+
+STRIPES_PER_CONTROLLER = 5
+
+
+def setup(loop, controllers, stripes, effect_type):
+    """
+    Builds controllers on one simulated bus, each driving stripes stripes, all running one effect group.
+    :rtype: (ledd.scheduler.FrameScheduler, list[ledd.controller.Controller])
+    """
+    cs = [Controller(id=i + 1, channels=16, i2c_device=0, address=hex(0x40 + i), _pwm_freq=1526)
+          for i in range(controllers)]
+    stack = EffectStack(effect_type())
+
+    for c in cs:
+        for n in range(stripes):
+            s = Stripe(id=len(stack.stripes) + 1, name="bench", rgb=True,
+                       channel_r=3 * n, channel_g=3 * n + 1, channel_b=3 * n + 2)
+            s.controller = c
+            c.stripes.append(s)
+            stack.stripes.append(s)
+
+    scheduler = FrameScheduler(loop, cs)
+    scheduler.add(stack)
+    return scheduler, cs
+
+
+def run(loop, controllers, stripes, effect, frames):
+    """
+    :return: measurements of one run
+    :rtype: dict
+    """
+    scheduler, cs = setup(loop, controllers, stripes, EFFECTS[effect])
+    bus = cs[0].bus
+    sim = simbus.buses[bus.device]
+    stacks = list(scheduler.stacks)
+
+    # warm up, probing and baking the frame table are not part of the measurement
+    scheduler.flush(scheduler.render(stacks))
+    bus.flush()
+    before = sim.stats
+    started, cpu = time.perf_counter(), time.process_time()
+
+    for _ in range(frames):
+        scheduler.flush(scheduler.render(stacks))
+        # wait for the bus worker, so a frame is complete when the next one starts
+        bus.flush()
+
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+    after = sim.stats
+
+    for c in cs:
+        c.close()
+
+    return {
+        'controllers': controllers,
+        'stripes': controllers * stripes,
+        'effect': effect,
+        'frames': frames,
+        'fps': frames / elapsed,
+        'transactions_per_frame': (after['transactions'] - before['transactions']) / frames,
+        'bytes_per_frame': (after['bytes_written'] + after['bytes_read'] -
+                            before['bytes_written'] - before['bytes_read']) / frames,
+        'cpu_ms_per_frame': cpu * 1000 / frames,
+        'wall_ms_per_frame': elapsed * 1000 / frames
+    }
+
+
+def first_rpc(port, deadline):
+    """
+    Connects until the daemon accepts and answers a discover request.
+    :return: time at which the answer arrived
+    """
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1.0) as s:
+                s.sendall(b'{"jsonrpc": "2.0", "id": 1, "method": "discover"}\n')
+                if s.makefile('rb').readline():
+                    return time.perf_counter()
+        except OSError:
+            time.sleep(0.005)
+    raise TimeoutError("The daemon did not answer within the timeout")
+
+
+def startup(runs, port, timeout=60.0):
+    """
+    Starts ledd.py runs times in the same working directory, so only the first start creates the database.
+    :return: seconds until the first RPC was answered, per run
+    :rtype: list[float]
+    """
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ledd.py')
+    times = []
+
+    with tempfile.TemporaryDirectory() as cwd:
+        with open(os.path.join(cwd, 'ledd.config'), 'w') as f:
+            f.write("[daemon]\nhost = 127.0.0.1\nport = {}\n".format(port))
+
+        for _ in range(runs):
+            started = time.perf_counter()
+            process = subprocess.Popen([sys.executable, script], cwd=cwd,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                times.append(first_rpc(port, started + timeout) - started)
+            finally:
+                process.terminate()
+                process.wait()
+
+    return times
+
+
+def import_times(top=15):
+    """
+    :return: the slowest imports of ledd.daemon by cumulative time, in seconds
+    :rtype: list[dict]
+    """
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ledd.daemon'],
+                               stderr=subprocess.PIPE, universal_newlines=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    _, err = process.communicate()
+
+    imports = []
+    for line in err.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or not fields[0].strip().isdigit():
+            continue
+        imports.append({'module': fields[2].strip(), 'self': int(fields[0]) / 1e6, 'cumulative': int(fields[1]) / 1e6})
+
+    return sorted(imports, key=lambda i: i['cumulative'], reverse=True)[:top]
+
+
+def main(argv=None):
+    arguments = docopt(__doc__, argv=argv)
+
+    if arguments['startup']:
+        times = startup(int(arguments['--runs']), int(arguments['--port']))
+        report = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'first_rpc': times,
+            'first_rpc_min': min(times),
+            'first_rpc_median': sorted(times)[len(times) // 2]
+        }
+        if arguments['--importtime']:
+            report['imports'] = import_times()
+        write_report(report, arguments['--output'])
+        return
+
+    simbus.SMBus.latency = float(arguments['--latency'])
+    simbus.SMBus.byte_time = float(arguments['--byte-time'])
+    frames = int(arguments['--frames'])
+    loop = asyncio.new_event_loop()
+
+    results = []
+    for effect in arguments['--effects'].split(','):
+        if effect not in EFFECTS:
+            sys.exit("Unknown effect: {}; known: {}".format(effect, ", ".join(sorted(EFFECTS))))
+        for controllers in (int(n) for n in arguments['--controllers'].split(',')):
+            for stripes in (int(n) for n in arguments['--stripes'].split(',')):
+                stripes = min(stripes, STRIPES_PER_CONTROLLER)
+                results.append(run(loop, controllers, stripes, effect, frames))
+
+    loop.close()
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'latency': simbus.SMBus.latency,
+        'byte_time': simbus.SMBus.byte_time,
+        'results': results
+    }
+    write_report(report, arguments['--output'])
+
+
+def write_report(report, output):
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Internal color representation.
+
+Single colors are (r, g, b) or (h, s, v) tuples of floats, frames of many colors are flat arrays of such triples.
+Pixel stripes use bytes of 8 bit r, g, b triples instead, those are copied and translated without a Python loop.
+Hue is given in degrees like in spectra, all other components are in [0, 1].
+The daemon does not import spectra, it takes a noticeable part of the startup time. Effects may still yield
+spectra colors.
+"""
+
+RGB = "rgb"
+HSV = "hsv"
+PIXELS = "pixels"
+""" frames of pixel effects, bytes of 8 bit r, g, b triples for every pixel """
+
+
+def clamp(value):
+    return 0.0 if value < 0.0 else 1.0 if value > 1.0 else value
+
+
+def hsv_to_rgb(h, s, v):
+    if s <= 0.0:
+        return v, v, v
+
+    h = (h % 360.0) / 60.0
+    i = int(h)
+    f = h - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+
+    if i == 0:
+        return v, t, p
+    if i == 1:
+        return q, v, p
+    if i == 2:
+        return p, v, t
+    if i == 3:
+        return p, q, v
+    if i == 4:
+        return t, p, v
+    return v, p, q
+
+
+def hsv_to_clamped_rgb(h, s, v):
+    """
+    Like spectra.hsv(h, s, v).clamped_rgb, for colors received over JSON-RPC.
+    """
+    r, g, b = hsv_to_rgb(h, s, v)
+    return clamp(r), clamp(g), clamp(b)
+
+
+def rgb_to_hsv(r, g, b):
+    maxc = max(r, g, b)
+    minc = min(r, g, b)
+    if maxc == minc:
+        return 0.0, 0.0, maxc
+
+    delta = maxc - minc
+    s = delta / maxc
+    if r == maxc:
+        h = (g - b) / delta
+    elif g == maxc:
+        h = 2.0 + (b - r) / delta
+    else:
+        h = 4.0 + (r - g) / delta
+
+    return (h * 60.0) % 360.0, s, maxc
+
@@ -16,13 +16,16 @@
 
 import errno
 import logging
+import threading
 import time
+from contextlib import contextmanager
 
-import smbus
 from sqlalchemy import Column, Integer, String
-from sqlalchemy.orm import relationship, reconstructor
+from sqlalchemy.orm import reconstructor
 
 from . import Base
+from .gamma import gamma_correct, gamma_table, MAXVAL
+from .i2cbus import get_bus, I2C_BLOCK_MAX
 
 PCA9685_SUBADR1 = 0x2
 PCA9685_SUBADR2 = 0x3
@@ -42,6 +45,18 @@ ALLLED_ON_H = 0xFB
 ALLLED_OFF_L = 0xFC
 ALLLED_OFF_H = 0xFD
 
+PCA9685_CHANNELS = 16
+
+LED_FULL = 0x1000
+""" full on/off bit of the LEDn_ON and LEDn_OFF words, set in LEDn_OFF after power on """
+
+MODE1_SLEEP = 0x10
+MODE1_AI = 0x20
+MODE1_RESTART = 0x80
+
+# SMBus block transfers carry at most 32 bytes, which are 8 channels of 4 registers each
+I2C_BLOCK_CHANNELS = I2C_BLOCK_MAX // 4
+
 
 class Controller(Base):
     __tablename__ = "controller"
@@ -50,50 +65,256 @@ class Controller(Base):
     channels = Column(Integer)
     i2c_device = Column(Integer)
     address = Column(String)
-    stripes = relationship("Stripe", backref="controller")
     _pwm_freq = Column("pwm_freq", Integer, default=1526)
+    """ configured PWM frequency, like all mapped attributes only changed in the db thread once persistent """
 
     """
     A controller controls a number of stripes.
+    Mapped attributes belong to the session of the db thread. The links between controllers and stripes and
+    everything read from the hardware are plain attributes, used by the event loop and the bus threads.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.stripes = []
+        """ :type : list[ledd.stripe.Stripe] """
+        self._frequency = None
         self._mode = None
-        self.bus = smbus.SMBus(self.i2c_device)
+        self._status = None
+        self._shadow = {}
+        self._staged = {}
+        self._frame_depth = 0
+        self._lock = threading.RLock()
+        self.writes_sent = 0
+        self.writes_skipped = 0
         self._address = int(self.address, 16)
-        self.pwm_freq = self._pwm_freq
+        self.bus = get_bus(self.i2c_device)
+        self.bus.set_error_handler(self._address, self._write_failed)
+        self.probed = False
+        try:
+            self.probe()
+        except OSError:
+            # nobody will close a controller that was never created
+            self.close()
+            raise
 
     @reconstructor
     def init_on_load(self):
+        self.stripes = []
+        self._frequency = None
         self._mode = None
-        self.bus = smbus.SMBus(self.i2c_device)
+        self._status = None
+        self._shadow = {}
+        self._staged = {}
+        self._frame_depth = 0
+        self._lock = threading.RLock()
+        self.writes_sent = 0
+        self.writes_skipped = 0
         self._address = int(self.address, 16)
-        self.pwm_freq = self._pwm_freq
+        self.bus = get_bus(self.i2c_device)
+        self.bus.set_error_handler(self._address, self._write_failed)
+        # the hardware is initialized later by probe, so loading from the database never touches the bus
+        self.probed = False
 
     def __repr__(self):
         return "<Controller stripes={} cid={}>".format(len(self.stripes), self.id)
 
     def set_channel(self, channel, val, gamma):
-        self.bus.write_word_data(self._address, LED0_OFF_L + 4 * channel, self.gamma_correct(gamma, int(val * 4095),
-                                                                                             4095))
-        self.bus.write_word_data(self._address, LED0_ON_L + 4 * channel, 0)
+        self.stage(channel, gamma_table(gamma)[min(max(int(val * MAXVAL), 0), MAXVAL)])
 
     def set_all_channel(self, val):
-        self.bus.write_word_data(self._address, ALLLED_OFF_L, int(val * 4095))
-        self.bus.write_word_data(self._address, ALLLED_ON_L, 0)
+        with self._lock:
+            try:
+                self.bus.write_word_data(self._address, ALLLED_OFF_L, int(val * 4095))
+                self.bus.write_word_data(self._address, ALLLED_ON_L, 0)
+            except OSError:
+                self.invalidate_shadow()
+                raise
+            self.writes_sent += 2
+
+            # ALLLED writes every LEDn register, so the shadow is known for all of them
+            for channel in range(PCA9685_CHANNELS):
+                self._shadow[LED0_OFF_L + 4 * channel] = int(val * 4095)
+                self._shadow[LED0_ON_L + 4 * channel] = 0
+
+    def get_level(self, channel):
+        """
+        :return: the last written raw level of a channel from the shadow registers, 0 if unknown
+        """
+        return self._level(self._shadow.get(LED0_OFF_L + 4 * channel) or 0)
 
     @staticmethod
-    def gamma_correct(gamma, val, maxval):
-        corrected = int(pow(float(val) / float(maxval), float(gamma)) * float(maxval) + 0.5)
-        logging.getLogger(__name__).debug("GammaCorrect: in=%s out=%s, gamma=%s", val, corrected, gamma)
-        return corrected
+    def _level(off):
+        return 0.0 if off & LED_FULL else (off & MAXVAL) / MAXVAL
+
+    def begin(self):
+        """
+        Starts a frame. Channel values are only staged until the matching commit.
+        Frames may be nested, the outermost commit writes to the bus.
+        """
+        with self._lock:
+            self._frame_depth += 1
+
+    def stage(self, channel, value):
+        """
+        Stages the 12 bit OFF value of a channel. Outside of a frame the value is written immediately.
+        """
+        with self._lock:
+            self._staged[channel] = value
+
+            if not self._frame_depth:
+                self._flush()
+
+    def commit(self):
+        """
+        Ends a frame and writes all staged channels that differ from the shadow registers.
+        """
+        with self._lock:
+            if self._frame_depth:
+                self._frame_depth -= 1
+
+            if not self._frame_depth:
+                self._flush()
+
+    @contextmanager
+    def frame(self):
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.commit()
+
+    def flush(self):
+        """
+        Writes all staged channels, regardless of open frames.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.probed:
+            # kept until probe has read the registers
+            return
+
+        staged, self._staged = self._staged, {}
+        dirty = []
+
+        for channel in sorted(staged):
+            if self._shadow.get(LED0_ON_L + 4 * channel) == 0 and \
+                    self._shadow.get(LED0_OFF_L + 4 * channel) == staged[channel]:
+                self.writes_skipped += 1
+            else:
+                dirty.append(channel)
+
+        if not dirty:
+            return
+
+        self.enable_auto_increment()
+
+        for first, last in self._dirty_ranges(dirty):
+            data = []
+            for channel in range(first, last + 1):
+                data.extend((0, 0, staged[channel] & 0xFF, staged[channel] >> 8))
+
+            try:
+                self.bus.write_i2c_block_data(self._address, LED0_ON_L + 4 * first, data)
+            except OSError:
+                # the register content is unknown now, force a write next time
+                for channel in range(first, last + 1):
+                    self._shadow.pop(LED0_ON_L + 4 * channel, None)
+                    self._shadow.pop(LED0_OFF_L + 4 * channel, None)
+                raise
+
+            for channel in range(first, last + 1):
+                self._shadow[LED0_ON_L + 4 * channel] = 0
+                self._shadow[LED0_OFF_L + 4 * channel] = staged[channel]
+            self.writes_sent += 1
+
+    @staticmethod
+    def _dirty_ranges(dirty):
+        """
+        Groups sorted channel numbers into contiguous (first, last) runs that fit into one block transfer.
+        """
+        first = last = dirty[0]
+        for channel in dirty[1:]:
+            if channel == last + 1 and channel - first < I2C_BLOCK_CHANNELS:
+                last = channel
+            else:
+                yield first, last
+                first = last = channel
+        yield first, last
+
+    def enable_auto_increment(self):
+        """
+        Block writes rely on MODE1 auto increment, which is switched on if it is not already.
+        """
+        if self._mode is None:
+            self._mode = self.bus.read_byte_data(self._address, PCA9685_MODE1)
+
+        if not self._mode & MODE1_AI:
+            # never write RESTART back, it would restart the PWM cycle
+            self.mode = (self._mode | MODE1_AI) & ~MODE1_RESTART
+
+    def _write_failed(self, e):
+        # called by the bus worker, the register content is unknown now
+        logging.getLogger(__name__).warning("Writing to controller %s failed: %s", self.id, e)
+        with self._lock:
+            self.invalidate_shadow()
+
+    def probe(self):
+        """
+        Initializes the hardware. The PWM frequency is only programmed if PRESCALE differs, so a restart does not
+        reset the outputs. A controller still asleep since power on is woken up, PRESCALE may already match then.
+        All LED registers are then read into the shadow and values staged meanwhile are written.
+        """
+        with self._lock:
+            try:
+                if self.bus.read_byte_data(self._address, PCA9685_PRESCALE) != self.prescale(self._pwm_freq):
+                    self.pwm_freq = self._pwm_freq
+                elif self.mode & MODE1_SLEEP:
+                    self.wake()
+                self.read_shadow()
+            finally:
+                self.probed = True
+                self._status = None
+            self._flush()
+
+    def read_shadow(self):
+        """
+        Reads all LED registers into the shadow, one block transfer per I2C_BLOCK_CHANNELS channels.
+        """
+        with self._lock:
+            self.enable_auto_increment()
+            for first in range(0, PCA9685_CHANNELS, I2C_BLOCK_CHANNELS):
+                data = self.bus.read_i2c_block_data(self._address, LED0_ON_L + 4 * first, I2C_BLOCK_MAX)
+                for i in range(I2C_BLOCK_CHANNELS):
+                    self._shadow[LED0_ON_L + 4 * (first + i)] = data[4 * i] | data[4 * i + 1] << 8
+                    self._shadow[LED0_OFF_L + 4 * (first + i)] = data[4 * i + 2] | data[4 * i + 3] << 8
+
+    def invalidate_shadow(self):
+        """
+        Forgets all cached register values, e.g. after the controller was reset externally.
+        """
+        self._shadow.clear()
+
+    @property
+    def write_stats(self):
+        return {
+            'sent': self.writes_sent,
+            'skipped': self.writes_skipped
+        }
+
+    gamma_correct = staticmethod(gamma_correct)
 
     def get_channel(self, channel):
+        off = self._shadow.get(LED0_OFF_L + 4 * channel)
+        if off is not None:
+            return self._level(off)
+
         try:
-            return self.bus.read_word_data(self._address, LED0_OFF_L + 4 * channel) / 4095
+            return self._level(self.bus.read_word_data(self._address, LED0_OFF_L + 4 * channel))
         except OSError as e:
-            if int(e) == errno.ECOMM:
+            if e.errno == errno.ECOMM:
                 return 0
             else:
                 raise
@@ -103,9 +324,19 @@ class Controller(Base):
         time.sleep(0.015)
         self.mode = int("0b10100001", 2)
 
+    def wake(self):
+        """
+        Clears SLEEP and restarts the PWM outputs once the oscillator is stable, 500 us after waking up.
+        """
+        mode = self._mode & ~(MODE1_SLEEP | MODE1_RESTART)
+        self.mode = mode
+        time.sleep(0.0005)
+        self.mode = mode | MODE1_RESTART
+
     @property
     def mode(self):
         self._mode = self.bus.read_byte_data(self._address, PCA9685_MODE1)
+        self._status = None
         logging.getLogger(__name__).debug("Controller mode: %s", bin(self._mode))
         return self._mode
 
@@ -113,36 +344,68 @@ class Controller(Base):
     def mode(self, mode):
         self.bus.write_byte_data(self._address, PCA9685_MODE1, mode)
         self._mode = mode
+        self._status = None
         logging.getLogger(__name__).debug("Controller mode: %s", bin(self._mode))
 
     @property
     def pwm_freq(self):
-        self._pwm_freq = round(390625 / ((self.bus.read_byte_data(self._address, PCA9685_PRESCALE) + 1) * 64))
-        return self._pwm_freq
+        self._frequency = round(390625 / ((self.bus.read_byte_data(self._address, PCA9685_PRESCALE) + 1) * 64))
+        self._status = None
+        return self._frequency
 
     @pwm_freq.setter
     def pwm_freq(self, value):
         if value < 24 or value > 1526:
             raise ValueError("PWM frequency must be 24Hz <= pwm_freq <= 1526Hz: {}".format(value))
-        prescal = round((25000000.0 / (4096.0 * value))) - 1
+        prescal = self.prescale(value)
         logging.getLogger(__name__).debug("Presacle value: %s", prescal)
 
         self.mode = int("0b00110001", 2)
         self.bus.write_byte_data(self._address, PCA9685_PRESCALE, prescal)
         self.reset()
-        self._pwm_freq = value
+        self._frequency = value
+        self._status = None
+
+    @staticmethod
+    def prescale(pwm_freq):
+        """
+        :return: PRESCALE register value for a PWM frequency
+        :rtype: int
+        """
+        return round((25000000.0 / (4096.0 * pwm_freq))) - 1
+
+    def refresh_status(self):
+        """
+        Reads mode and PWM frequency back from the hardware, renewing the status snapshot.
+        """
+        try:
+            self.pwm_freq
+            self.mode
+        except OSError as e:
+            logging.getLogger(__name__).warning("Reading status of controller %s failed: %s", self.id, e)
+
+    def invalidate_status(self):
+        self._status = None
 
     def to_json(self):
-        return {
-            'id': self.id,
-            'pwm_freq': self.pwm_freq,
-            'channel': self.channels,
-            'address': self.address,
-            'stripes': self.stripes,
-            'cstripes': len(self.stripes),
-            'i2c_device': self.i2c_device,
-            'mode': self.mode
-        }
+        """
+        Serializes the cached status snapshot without touching the bus. Only the write counters are live.
+        """
+        status = self._status
+        if status is None:
+            status = self._status = {
+                'id': self.id,
+                'pwm_freq': self._frequency if self._frequency is not None else self._pwm_freq,
+                'channel': self.channels,
+                'address': self.address,
+                'stripes': list(self.stripes),
+                'cstripes': len(self.stripes),
+                'i2c_device': self.i2c_device,
+                'mode': self._mode
+            }
+
+        return dict(status, writes=self.write_stats)
 
     def close(self):
+        self.bus.remove_error_handler(self._address, self._write_failed)
         self.bus.close()
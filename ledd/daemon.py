@@ -17,23 +17,43 @@
 import asyncio
 import configparser
 import errno
+import json
 import logging
+import math
 import os
 import signal
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
-import spectra
 from jsonrpc import JSONRPCResponseManager, dispatcher
-from jsonrpc.exceptions import JSONRPCError, JSONRPCInvalidParams
+from jsonrpc.exceptions import JSONRPCError, JSONRPCInvalidParams, JSONRPCDispatchException, JSONRPCInternalError
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm.exc import NoResultFound
 
-from ledd import VERSION
-from ledd.controller import Controller
-from ledd.effectstack import EffectStack
+from ledd import VERSION, profiling, i2cbus
+from ledd.color import hsv_to_clamped_rgb, rgb_to_hsv
+from ledd.controller import Controller, PCA9685_CHANNELS
+from ledd.gamma import DEFAULT_GAMMA
+from ledd.effects.fadeeffect import FadeEffect
+from ledd.effects.frametable import frame_tables
+from ledd.effects.pixeleffect import PixelEffect
+from ledd.effects.rainboweffect import RainbowEffect
+from ledd.effectstack import EffectStack, EffectRegistry, PixelStack
+from ledd.framebuffer import FrameBuffer
 from ledd.models import Meta
+from ledd.notify import Hub, COLOR, EFFECT, CONTROLLER, TOPICS
+from ledd.pixelstripe import PixelStripe, ORDERS
+from ledd.pixeloutput import OUTPUTS
+from ledd.persistence import DBWorker, snapshot, save_states, load_states
+from ledd.registry import Registry
+from ledd.scheduler import FrameScheduler, StagedColor, ControllerLevel
+from ledd.stats import metrics, MetricsProtocol
 from ledd.stripe import Stripe
+from ledd.transition import EASINGS
+from ledd.udpframe import decode_frame, is_newer
 from . import Base, session
 
 log = logging.getLogger(__name__)
@@ -41,9 +61,31 @@ log = logging.getLogger(__name__)
 daemonSection = 'daemon'
 databaseSection = 'db'
 """ :type : asyncio.BaseEventLoop """
-effects = []
-stripes = []
-controller = []
+effect_types = [FadeEffect, RainbowEffect]
+""" available effects, their runtime eid is the index """
+registry = Registry()
+scheduler = None
+""" :type : ledd.scheduler.FrameScheduler """
+running_effects = None
+""" :type : ledd.effectstack.EffectRegistry """
+hub = None
+""" :type : ledd.notify.Hub """
+current_connection = None
+""" connection whose request is being handled, :type : LedDProtocol """
+db = None
+""" :type : ledd.persistence.DBWorker """
+persisted = {}
+""" last state handed to the db per stripe id """
+profile_dir = '.'
+""" directory stop_profile dumps profiles to """
+profile_handle = None
+""" stops the running profiling session when its time is up, :type : asyncio.Handle """
+last_profile = None
+""" :type : ledd.profiling.ProfilingSession """
+framebuffer = None
+""" :type : ledd.framebuffer.FrameBuffer """
+
+MAX_PROFILE_DURATION = 600
 
 
 def run():
@@ -51,31 +93,40 @@ def run():
         # read config
         config = configparser.ConfigParser()
         try:
-            with open('ledd.config', 'w+') as f:
+            with open('ledd.config', 'r') as f:
                 config.read_file(f)
         except FileNotFoundError:
             log.info("No config file found!")
 
         # SQL init
-        global engine
+        global engine, db
         engine = create_engine("sqlite:///" + config.get(databaseSection, 'name', fallback='ledd.sqlite'),
                                echo=log.getEffectiveLevel() == logging.DEBUG)
         session.configure(bind=engine)
         Base.metadata.bind = engine
-        if not check_db():
-            init_db()
+        db = DBWorker(config.getfloat(databaseSection, 'commit_delay', fallback=0.5))
+
+        bus_workers = config.get(daemonSection, 'bus_workers', fallback='thread')
+        if bus_workers == 'process':
+            from ledd.procbus import ProcessBus
+            i2cbus.bus_type = ProcessBus
+            log.info("Driving every i2c bus from a worker process")
+        elif bus_workers != 'thread':
+            log.warning("Unknown bus_workers %s, using threads", bus_workers)
 
         logging.getLogger("asyncio").setLevel(log.getEffectiveLevel())
 
         # Load to cache
-        global controller, stripes
-        controller = Controller.query.all()
-
-        for c in controller:
-            stripes.extend(c.stripes)
+        for c in db.call(load_db).result():
+            registry.add_controller(c)
+            for s in c.stripes:
+                registry.add_stripe(s)
+        for s in db.call(load_pixel_stripes).result():
+            open_pixel_stripe(s)
+            registry.add_pixel_stripe(s)
 
         # sigterm handler
-        def sigterm_handler():
+        def sigterm_handler(signum, frame):
             raise SystemExit
 
         signal.signal(signal.SIGTERM, sigterm_handler)
@@ -83,27 +134,79 @@ def run():
         # init plugins
         # TODO: check all plugins for existing hooks
 
+        frame_tables.max_bytes = config.getint(daemonSection, 'frame_cache_size', fallback=frame_tables.max_bytes)
+
         # main loop
-        global loop, server
+        global loop, server, scheduler, running_effects, hub, profile_dir, framebuffer
+        profile_dir = config.get(daemonSection, 'profile_dir', fallback=profile_dir)
         loop = asyncio.get_event_loop()
+        scheduler = FrameScheduler(loop, registry.controllers.values(),
+                                   config.getfloat(daemonSection, 'fps', fallback=10.0),
+                                   config.getboolean(daemonSection, 'render_workers', fallback=False))
+        running_effects = EffectRegistry(scheduler)
+        hub = Hub(loop)
+        scheduler.frame_listeners.append(hub.publish_frame)
+        metrics.collectors.append(collect_stats)
+        instrument_rpc()
+        states = db.call(load_states).result()
         coro = loop.create_server(LedDProtocol,
                                   config.get(daemonSection, 'host', fallback='0.0.0.0'),
                                   config.get(daemonSection, 'port', fallback=1425))
         server = loop.run_until_complete(coro)
+        # requests are accepted while the hardware is still being probed
+        probe_controllers(states)
+
+        udp_port = config.getint(daemonSection, 'udp_port', fallback=0)
+        if udp_port:
+            loop.run_until_complete(loop.create_datagram_endpoint(
+                LedDDatagramProtocol, (config.get(daemonSection, 'host', fallback='0.0.0.0'), udp_port)))
+            log.info("Listening for UDP frames on port %s", udp_port)
+
+        framebuffer_path = config.get(daemonSection, 'framebuffer', fallback='')
+        if framebuffer_path:
+            framebuffer = FrameBuffer(framebuffer_path, config.getint(daemonSection, 'framebuffer_slots', fallback=256))
+            log.info("Mapped framebuffer %s with %s slots", framebuffer_path, framebuffer.slots)
+
+        metrics_port = config.getint(daemonSection, 'metrics_port', fallback=0)
+        if metrics_port:
+            loop.run_until_complete(loop.create_server(
+                MetricsProtocol, config.get(daemonSection, 'host', fallback='0.0.0.0'), metrics_port))
+            log.info("Serving metrics on port %s", metrics_port)
+
+        status_interval = config.getfloat(daemonSection, 'status_interval', fallback=60.0)
+        if status_interval > 0:
+            loop.call_later(status_interval, refresh_status, status_interval)
+        persist_interval = config.getfloat(daemonSection, 'persist_interval', fallback=10.0)
+        if persist_interval > 0:
+            loop.call_later(persist_interval, persist_state, persist_interval)
         log.info("Start phase finished; starting main loop")
         loop.run_forever()
     except (KeyboardInterrupt, SystemExit):
         log.info("Exiting")
+        # a repeated signal must not interrupt the final commit
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        if scheduler is not None:
+            scheduler.stop()
+
+        profiling.stop()
 
-        for c in controller:
+        if framebuffer is not None:
+            framebuffer.close()
+
+        for c in registry.controllers.values():
             c.close()
+        for s in registry.pixel_stripes.values():
+            s.close()
 
         try:
             os.remove("ledd.pid")
         except FileNotFoundError:
             pass
-        session.commit()
-        session.close()
+        if db is not None:
+            if running_effects is not None:
+                persist_state()
+            db.close()
         if server is not None:
             server.close()
         if loop is not None:
@@ -112,6 +215,178 @@ def run():
         sys.exit(0)
 
 
+def refresh_status(interval):
+    """
+    Re-reads the status of all controllers off the event loop, so get_stripes never has to touch the bus.
+    """
+    for c in registry.controllers.values():
+        loop.run_in_executor(None, c.refresh_status)
+
+    loop.call_later(interval, refresh_status, interval)
+
+
+def instrument_rpc():
+    """
+    Wraps every registered RPC method, so its latency and call count end up in the metrics.
+    """
+    for name, method in list(dispatcher.items()):
+        dispatcher[name] = metrics.timed('ledd_rpc_seconds', method, method=name)
+
+
+def collect_stats():
+    """
+    Counter samples of the render clock and every controller, only gathered when the metrics are read.
+    """
+    yield 'ledd_frames_total', {}, scheduler.frames
+    yield 'ledd_frame_overruns_total', {}, scheduler.overruns
+
+    for c in registry.controllers.values():
+        labels = {'controller': c.id, 'i2c_device': c.i2c_device, 'address': c.address}
+        counters = c.bus.by_address.get(int(c.address, 16), {})
+        for key in ('transactions', 'bytes', 'errors'):
+            yield 'ledd_i2c_{}_total'.format(key), labels, counters.get(key, 0)
+        yield 'ledd_writes_skipped_total', labels, c.writes_skipped
+
+    for s in registry.pixel_stripes.values():
+        yield 'ledd_pixel_frames_total', {'stripe': s.id}, s.frames
+        yield 'ledd_pixel_errors_total', {'stripe': s.id}, s.errors
+
+    if framebuffer is not None:
+        yield 'ledd_framebuffer_updates_total', {}, framebuffer.updates
+        yield 'ledd_framebuffer_torn_reads_total', {}, framebuffer.torn
+
+
+def persist_state(interval=None):
+    """
+    Hands the stripes whose color or effect changed since the last call to the db thread.
+    """
+    states = {}
+    for sid, stripe in registry.stripes.items():
+        state = snapshot(stripe, running_effects.for_stripe(sid))
+        if persisted.get(sid) != state:
+            states[sid] = state
+
+    if states:
+        persisted.update(states)
+        db.submit(save_states, states)
+
+    if interval:
+        loop.call_later(interval, persist_state, interval)
+
+
+def probe_controllers(states):
+    """
+    Initializes the controllers of every bus in a thread of their own and restores the saved state afterwards.
+    Until a controller is probed, writes to it are only staged.
+    :type states: dict[int, ledd.models.StripeState]
+    """
+    buses = OrderedDict()
+    for c in registry.controllers.values():
+        buses.setdefault(c.i2c_device, []).append(c)
+
+    if not buses:
+        restore_state(states)
+        return
+
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(len(buses))
+    probes = [loop.run_in_executor(executor, probe_bus, controllers) for controllers in buses.values()]
+
+    def probed(future):
+        executor.shutdown(wait=False)
+        log.info("Probed %s controllers on %s buses in %.3fs",
+                 len(registry.controllers), len(buses), time.monotonic() - started)
+        restore_state(states)
+
+    asyncio.gather(*probes).add_done_callback(probed)
+
+
+def probe_bus(controllers):
+    """
+    Runs in a probe thread, the controllers of one bus are probed one after another.
+    :type controllers: list[ledd.controller.Controller]
+    """
+    for c in controllers:
+        try:
+            c.probe()
+        except OSError as e:
+            log.warning("Probing controller %s on i2c device %s failed: %s", c.id, c.i2c_device, e)
+
+
+def restore_state(states):
+    """
+    Brings the stripes back to the colors and effects saved before the last shutdown.
+    Only stripes without a saved state are read back from the bus.
+    :type states: dict[int, ledd.models.StripeState]
+    """
+    names = {effect_type.__name__: effect_type for effect_type in effect_types}
+    groups = OrderedDict()
+
+    for sid, stripe in registry.stripes.items():
+        state = states.get(sid)
+        if state is None:
+            stripe.read_color()
+            continue
+
+        persisted[sid] = (state.color, state.effect, state.effect_options)
+        if state.effect in names:
+            groups.setdefault((state.effect, state.effect_options), []).append(stripe)
+        elif state.color is not None:
+            scheduler.stage(stripe, state.color)
+        else:
+            stripe.read_color()
+
+    # stripes that ran the same effect with the same options are restored as one group
+    for (name, options), stripes in groups.items():
+        stack = EffectStack(names[name](json.loads(options)))
+        stack.stripes.extend(stripes)
+        running_effects.start(stack)
+        log.info("Restored %s on stripes %s", name, [s.id for s in stripes])
+
+
+def load_db():
+    """
+    Runs in the db thread.
+    :return: all controllers, with their stripes loaded
+    :rtype: list[ledd.controller.Controller]
+    """
+    if not check_db():
+        init_db()
+    else:
+        # tables added since the database was created
+        Base.metadata.create_all()
+
+    controllers = Controller.query.all()
+    by_id = {c.id: c for c in controllers}
+    for s in Stripe.query.order_by(Stripe.id):
+        c = by_id.get(s.controller_id)
+        if c is None:
+            log.warning("Controller %s of stripe %s not found", s.controller_id, s.id)
+            continue
+        s.controller = c
+        c.stripes.append(s)
+    return controllers
+
+
+def load_pixel_stripes():
+    """
+    Runs in the db thread.
+    :rtype: list[ledd.pixelstripe.PixelStripe]
+    """
+    return PixelStripe.query.all()
+
+
+def open_pixel_stripe(s):
+    """
+    A pixel stripe whose output can't be opened stays known, its frames are dropped.
+    :type s: ledd.pixelstripe.PixelStripe
+    """
+    try:
+        s.open()
+    except (OSError, KeyError) as e:
+        log.warning("Opening %s output %s of pixel stripe %s failed: %s", s.output, s.device, s.id, e)
+
+
 def check_db():
     """
     Checks database version
@@ -132,83 +407,145 @@ def check_db():
 def init_db():
     Base.metadata.drop_all()
     Base.metadata.create_all()
-    session.add(Meta(option="db_version", value="2"))
+    session.add(Meta(option="db_version", value="4"))
     session.commit()
     check_db()
 
 
-@dispatcher.add_method
+def rpc_method(fn):
+    """
+    Registers fn with the dispatcher. Handlers return a JSONRPCError for a failed request, the dispatcher only turns
+    raised errors into error responses, so returned ones are raised for it.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        result = fn(*args, **kwargs)
+        if isinstance(result, JSONRPCError):
+            raise JSONRPCDispatchException(result.code, result.message, result.data)
+        return result
+
+    dispatcher.add_method(wrapper)
+    return fn
+
+
+@rpc_method
 def start_effect(**kwargs):
     """
-    Part of the Color API. Used to start a specific effect.
+    Part of the Color API. Used to start a specific effect. Pixel effects run on pixel stripes, all others on stripes.
     Required parameters: stripe IDs: sids; effect id: eid, effect options: eopt
     :param kwargs:
     """
 
-    if "sids" not in kwargs or "eid" not in kwargs or "eopt" not in kwargs:
+    if "sids" not in kwargs or "eid" not in kwargs or "eopt" not in kwargs or not isinstance(kwargs['eopt'], dict):
         return JSONRPCInvalidParams()
 
-    for stripe in Stripe.query.filter(Stripe.id.in_(kwargs['sids'])):
-        # TODO: add anything required to start effect with req_json['eid']
-        # on stripes[] with options in req_json['eopt']
-        effect = EffectStack()
-        effects.append(effect)
-        effect.stripes.append(stripe)
-        effect.start()
+    eid = kwargs['eid']
+    # negative indexes and booleans would pick an effect type as well
+    if isinstance(eid, bool) or not isinstance(eid, int) or not 0 <= eid < len(effect_types):
+        log.warning("Effect not found: eid=%s", eid)
+        return JSONRPCError(-1005, "Effect not found")
+    effect_type = effect_types[eid]
 
-        # asyncio.ensure_future(asyncio.get_event_loop().run_in_executor(executor, effect.execute))
+    if issubclass(effect_type, PixelEffect):
+        sstripes = registry.find_pixel_stripes(kwargs['sids'])
+        stack = PixelStack(effect_type(kwargs['eopt']))
+    else:
+        sstripes = registry.find_stripes(kwargs['sids'])
+        stack = EffectStack(effect_type(kwargs['eopt']))
 
-        rjson = {
-            'eident': None,  # unique effect identifier that identifies excatly this effect started on this set of
-            # stripes, used to stop them later and to give informations about running effects
-        }
+    if not sstripes:
+        return JSONRPCError(-1003, "Stripeid not found")
 
-        return rjson
+    stack.stripes.extend(sstripes)
+    eident = running_effects.start(stack)
+    hub.publish(EFFECT, eident, dict(stack.to_json(), running=True))
 
-    return JSONRPCError(-1003, "Stripeid not found")
+    return {
+        'eident': eident,  # unique effect identifier that identifies excatly this effect started on this set of
+        # stripes, used to stop them later and to give informations about running effects
+    }
 
 
-@dispatcher.add_method
+@rpc_method
 def stop_effect(**kwargs):
     """
     Part of the Color API. Used to stop a specific effect.
     Required parameters: effect identifier: eident
     """
 
-    # TODO: add stop effect by eident logic
+    if "eident" not in kwargs:
+        return JSONRPCInvalidParams()
+
+    stack = running_effects.stop(kwargs['eident'])
+
+    if stack is None:
+        log.warning("Running effect not found: eident=%s", kwargs['eident'])
+        return JSONRPCError(-1006, "Effect identifier not found")
 
+    hub.publish(EFFECT, stack.eident, dict(stack.to_json(), running=False))
 
-@dispatcher.add_method
+    return ""
+
+
+@rpc_method
 def get_effects(**kwargs):
     """
     Part of the Color API. Used to show all available and running effects.
     Required parameters: -
     """
 
-    # TODO: list all effects here and on which stripes they run atm
-    # TODO: all effects get runtime only ids, "eid"'s. They are shown here for the client to start effects.
-    # TODO: All options that an effect may have need to be transmitted here too with "eopt".
+    rjson = {
+        'effects': [{
+            'eid': eid,
+            'name': effect_type.name,
+            'description': getattr(effect_type, "description", ""),
+            'version': effect_type.version,
+            'author': effect_type.author
+        } for eid, effect_type in enumerate(effect_types)],
+        'running': list(running_effects)
+    }
+
+    return rjson
 
 
-@dispatcher.add_method
+@rpc_method
 def set_color(**kwargs):
     """
     Part of the Color API. Used to set color of a stripe.
     Required parameters: stripe ID: sid; HSV values hsv: h,s,v, controller id: cid
+    Optional parameters: duration: fade time in seconds; easing: linear, ease_in, ease_out or ease_in_out
     """
 
     if "sid" not in kwargs or "hsv" not in kwargs:
         return JSONRPCInvalidParams()
 
-    stripe = get_stripe(kwargs['sid'])
+    duration, easing = transition_params(kwargs)
+    if duration is None:
+        return JSONRPCInvalidParams()
+
+    hsv = hsv_params(kwargs['hsv'])
+    if hsv is None:
+        return JSONRPCInvalidParams()
+
+    stripe = registry.get_stripe(kwargs['sid'])
+    color = hsv_to_clamped_rgb(*hsv)
 
-    if stripe:
+    if stripe and duration > 0:
+        key = ('stripe', stripe.id)
+        # a running fade is retargeted from where it currently is
+        start = scheduler.current(key) or stripe.color or color
+        scheduler.fade(key, StagedColor(stripe), start, color, duration, easing)
+    elif stripe:
+        scheduler.cancel(('stripe', stripe.id))
         try:
-            stripe.set_color(spectra.hsv(kwargs['hsv']['h'], kwargs['hsv']['s'], kwargs['hsv']['v']))
+            with stripe.controller.frame():
+                StagedColor(stripe).apply(color, scheduler.matrix())
+            hub.publish(COLOR, stripe.id, stripe.color)
         except OSError as e:
-            if int(e) == errno.ECOMM:
+            if e.errno == errno.ECOMM:
                 log.warning("Communication error on I2C Bus")
-                return e
+                return JSONRPCError(-1009, "Internal Error", str(e))
             else:
                 raise
     else:
@@ -218,29 +555,79 @@ def set_color(**kwargs):
     return ""
 
 
-@dispatcher.add_method
+@rpc_method
 def set_color_all(**kwargs):
     """
     Part of the Color API. Used to set brightness of all stripes a controller owns.
     Required parameters: controller id: cid, value: v
+    Optional parameters: duration: fade time in seconds; easing: linear, ease_in, ease_out or ease_in_out
     """
 
     if "cid" not in kwargs or "v" not in kwargs:
         return JSONRPCInvalidParams()
 
+    duration, easing = transition_params(kwargs)
+    if duration is None:
+        return JSONRPCInvalidParams()
+
     try:
-        c = get_controller(kwargs['cid'])
-        """ :type c: ledd.controller.Controller """
+        value = float(kwargs['v'])
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+    if not 0.0 <= value <= 1.0:
+        return JSONRPCInvalidParams()
 
-        c.set_all_channel(kwargs['v'])
-    except NoResultFound:
+    c = registry.get_controller(kwargs['cid'])
+
+    if c is None:
         log.warning("Controller not found: id=%s", kwargs['cid'])
         return JSONRPCError(-1002, "Controller not found")
 
+    key = ('controller', c.id)
+    if duration > 0:
+        start = scheduler.current(key) or [c.get_level(channel) for channel in range(PCA9685_CHANNELS)]
+        scheduler.fade(key, ControllerLevel(c), start, [value] * PCA9685_CHANNELS, duration, easing)
+    else:
+        scheduler.cancel(key)
+        c.set_all_channel(value)
+    hub.publish(CONTROLLER, c.id, c)
+
     return ""
 
 
-@dispatcher.add_method
+def transition_params(kwargs):
+    """
+    :return: duration and easing of a color change; duration is None if the parameters are invalid
+    """
+    easing = kwargs.get('easing', 'linear')
+
+    try:
+        duration = float(kwargs.get('duration', 0))
+    except (TypeError, ValueError):
+        return None, easing
+
+    if easing not in EASINGS or not math.isfinite(duration) or duration < 0:
+        return None, easing
+
+    return duration, easing
+
+
+def hsv_params(hsv):
+    """
+    :return: (h, s, v) as floats, None if a component is missing, not a number or out of range
+    """
+    try:
+        h, s, v = float(hsv['h']), float(hsv['s']), float(hsv['v'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if not math.isfinite(h) or not 0.0 <= s <= 1.0 or not 0.0 <= v <= 1.0:
+        return None
+
+    return h, s, v
+
+
+@rpc_method
 def add_controller(**kwargs):
     """
     Part of the Color API. Used to add a controller.
@@ -256,17 +643,17 @@ def add_controller(**kwargs):
                                  address=kwargs['address'], _pwm_freq=1526)
     except OSError as e:
         log.error("Error opening i2c device: %s (%s)", kwargs['i2c_dev'], e)
-        return JSONRPCError(-1004, "Error while opening i2c device", e)
+        return JSONRPCError(-1004, "Error while opening i2c device", str(e))
 
-    session.add(ncontroller)
-    session.commit()
-
-    controller.append(ncontroller)
+    ncontroller.id = registry.next_controller_id()
+    registry.add_controller(ncontroller)
+    db.submit(session.add, ncontroller)
+    hub.publish(CONTROLLER, ncontroller.id, ncontroller)
 
     return {'cid': ncontroller.id}
 
 
-@dispatcher.add_method
+@rpc_method
 def get_color(**kwargs):
     """
     Part of the Color API. Used to get the current color of an stripe.
@@ -276,20 +663,20 @@ def get_color(**kwargs):
     if "sid" not in kwargs:
         return JSONRPCInvalidParams()
 
-    stripe = get_stripe(kwargs['sid'])
+    stripe = registry.get_stripe(kwargs['sid'])
 
     if not stripe:
         log.warning("Stripe not found: id=%s", kwargs['sid'])
         return JSONRPCError(-1003, "Stripeid not found")
 
     if stripe.color:
-        return {'color': stripe.color.values}
+        return {'color': rgb_to_hsv(*stripe.color)}
     else:
         log.warning("Stripe has no color: id=%s", kwargs['sid'])
         return JSONRPCError(-1009, "Internal Error")
 
 
-@dispatcher.add_method
+@rpc_method
 def add_stripe(**kwargs):
     """
     Part of the Color API. Used to add stripes.
@@ -299,26 +686,231 @@ def add_stripe(**kwargs):
     if "name" not in kwargs or "rgb" not in kwargs or "map" not in kwargs or "cid" not in kwargs:
         return JSONRPCInvalidParams()
 
-    c = get_controller(kwargs['cid'])
-    """ :type c: ledd.controller.Controller """
+    c = registry.get_controller(kwargs['cid'])
 
     if c is None:
         log.warning("Controller not found: id=%s", kwargs['cid'])
         return JSONRPCError(-1002, "Controller not found")
 
-    s = Stripe(name=kwargs['name'], rgb=bool(kwargs['rgb']),
-               channel_r=kwargs['map']['r'], channel_g=kwargs['map']['g'], channel_b=kwargs['map']['b'])
+    for channel in (kwargs['map']['r'], kwargs['map']['g'], kwargs['map']['b']):
+        other = registry.stripe_on_channel(c.id, channel)
+        if other is not None:
+            log.warning("Channel %s of controller %s is already used by stripe %s", channel, c.id, other.id)
+
+    s = Stripe(id=registry.next_stripe_id(), name=kwargs['name'], rgb=bool(kwargs['rgb']),
+               channel_r=kwargs['map']['r'], channel_g=kwargs['map']['g'], channel_b=kwargs['map']['b'],
+               controller_id=c.id)
+    # plain attributes, the controller stays untouched by the session of the db thread
     s.controller = c
+    c.stripes.append(s)
     log.debug("Added stripe %s to controller %s; new len %s", s.id, c.id, len(c.stripes))
 
-    session.add(s)
-    session.commit()
-    stripes.append(s)
+    registry.add_stripe(s)
+    db.submit(session.add, s)
+    hub.publish(CONTROLLER, c.id, c)
 
     return {'sid': s.id}
 
 
-@dispatcher.add_method
+@rpc_method
+def add_pixel_stripe(**kwargs):
+    """
+    Part of the Color API. Used to add addressable stripes with a color per pixel.
+    Required parameters: name; pixels: number of pixels; output: spi, file or loopback;
+                         device: e.g. /dev/spidev0.0 for spi, a path for file
+    Optional parameters: speed: spi clock in Hz; order: color order of the chips, e.g. grb (default rgb);
+                         gamma (default 2.8)
+    """
+
+    if "name" not in kwargs or "pixels" not in kwargs or "output" not in kwargs:
+        return JSONRPCInvalidParams()
+
+    if kwargs['output'] not in OUTPUTS or kwargs.get('order', 'rgb') not in ORDERS:
+        return JSONRPCInvalidParams()
+
+    try:
+        s = PixelStripe(id=registry.next_stripe_id(), name=kwargs['name'], pixels=int(kwargs['pixels']),
+                        output=kwargs['output'], device=kwargs.get('device'), speed=kwargs.get('speed'),
+                        order=kwargs.get('order', 'rgb'), gamma=float(kwargs.get('gamma', DEFAULT_GAMMA)))
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+
+    try:
+        s.open()
+    except OSError as e:
+        log.error("Error opening %s output %s: %s", s.output, s.device, e)
+        return JSONRPCError(-1015, "Error while opening pixel output", str(e))
+
+    registry.add_pixel_stripe(s)
+    db.submit(session.add, s)
+
+    return {'sid': s.id}
+
+
+@rpc_method
+def set_modifiers(**kwargs):
+    """
+    Part of the Color API. Used to change brightness, color temperature and saturation of everything the daemon
+    renders, or of one running effect only. Changes apply with the next frame, effects keep running.
+    Optional parameters: eident: running effect (default all stripes); brightness: 0 to 1; temperature: white point
+                         in kelvin, 6500 is neutral; saturation: 0 (gray) to 2, 1 is unchanged
+    """
+
+    if "eident" in kwargs:
+        stack = running_effects.get(kwargs['eident'])
+        if stack is None:
+            return JSONRPCError(-1006, "Effect identifier not found")
+        modifiers = stack.modifiers
+    else:
+        stack = None
+        modifiers = scheduler.modifiers
+
+    try:
+        modifiers.update(kwargs.get('brightness'), kwargs.get('temperature'), kwargs.get('saturation'))
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+
+    if stack is not None:
+        hub.publish(EFFECT, stack.eident, dict(stack.to_json(), running=True))
+    else:
+        restage(registry.stripes.values())
+
+    return modifiers.to_json()
+
+
+@rpc_method
+def get_modifiers(**kwargs):
+    """
+    Part of the Color API. Used to get the modifiers of all stripes or of one running effect.
+    Optional parameters: eident
+    """
+
+    if "eident" not in kwargs:
+        return scheduler.modifiers.to_json()
+
+    stack = running_effects.get(kwargs['eident'])
+    if stack is None:
+        return JSONRPCError(-1006, "Effect identifier not found")
+    return stack.modifiers.to_json()
+
+
+@rpc_method
+def set_limit(**kwargs):
+    """
+    Part of the Color API. Used to cap the level of every channel of a stripe or pixel stripe, e.g. to stay within
+    the budget of its power supply. The limit applies after all modifiers.
+    Required parameters: stripe ID: sid; limit: 0 to 1
+    """
+
+    if "sid" not in kwargs or "limit" not in kwargs:
+        return JSONRPCInvalidParams()
+
+    stripe = registry.get_stripe(kwargs['sid']) or registry.pixel_stripes.get(kwargs['sid'])
+    if stripe is None:
+        return JSONRPCError(-1003, "Stripeid not found")
+
+    try:
+        limit = float(kwargs['limit'])
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+    if not 0.0 <= limit <= 1.0:
+        return JSONRPCInvalidParams()
+
+    stripe.limit = limit
+    if stripe.id in registry.stripes:
+        restage([stripe])
+
+    return ""
+
+
+def restage(stripes):
+    """
+    Stages the current color of stripes that are not rendered with every frame again, so changed modifiers reach them.
+    """
+    for stripe in stripes:
+        if stripe.color is None or running_effects.for_stripe(stripe.id) is not None:
+            continue
+        if ('stripe', stripe.id) not in scheduler.transitions:
+            scheduler.stage(stripe, stripe.color)
+
+
+@rpc_method
+def get_stats(**kwargs):
+    """
+    Part of the Color API. Used to get the runtime metrics: render and flush times, frame overruns, I2C counters
+    per controller and RPC latencies per method.
+    Required parameters: -
+    """
+    return metrics.to_json()
+
+
+@rpc_method
+def start_profile(**kwargs):
+    """
+    Part of the Color API. Used to start a time boxed profiling session, results are fetched with stop_profile.
+    Optional parameters: mode: sampling (all threads, low overhead) or cprofile (event loop only, exact),
+                         default sampling; duration: seconds until the session stops by itself (default 30);
+                         interval: seconds between two samples (default 0.005)
+    """
+    global profile_handle
+
+    if profiling.session is not None:
+        return JSONRPCError(-1010, "Profiling already running")
+
+    try:
+        duration = min(float(kwargs.get('duration', 30)), MAX_PROFILE_DURATION)
+        interval = float(kwargs.get('interval', 0.005))
+        if duration <= 0 or interval <= 0:
+            return JSONRPCInvalidParams()
+        session = profiling.start(kwargs.get('mode', profiling.SAMPLING), duration, interval)
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+
+    profile_handle = loop.call_later(duration, finish_profile)
+    return {'mode': session.mode, 'duration': duration}
+
+
+@rpc_method
+def stop_profile(**kwargs):
+    """
+    Part of the Color API. Used to stop the profiling session, or to get the results of the last one once its time
+    is up. Returns the most expensive functions and the render time per effect.
+    Optional parameters: top: number of functions (default 20); sort: self or total (default self);
+                         file: name of a file in the profile directory the whole profile is written to, pstats data
+                         for cprofile, folded stacks for sampling
+    """
+    if profiling.session is not None:
+        profile_handle.cancel()
+        finish_profile()
+
+    if last_profile is None:
+        return JSONRPCError(-1011, "No profiling session")
+
+    try:
+        result = last_profile.summary(int(kwargs.get('top', 20)), kwargs.get('sort', 'self'))
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+
+    if 'file' in kwargs:
+        # only file names are accepted, the profile never ends up outside of the profile directory
+        path = os.path.abspath(os.path.join(profile_dir, os.path.basename(str(kwargs['file']))))
+        try:
+            last_profile.dump(path)
+        except OSError as e:
+            log.error("Writing profile to %s failed: %s", path, e)
+            return JSONRPCError(-1009, "Internal Error", str(e))
+        result['file'] = path
+
+    return result
+
+
+def finish_profile():
+    global profile_handle, last_profile
+    profile_handle = None
+    last_profile = profiling.stop()
+
+
+@rpc_method
 def get_stripes(**kwargs):
     """
     Part of the Color API. Used to get all registered stripes known to the daemon.
@@ -326,14 +918,15 @@ def get_stripes(**kwargs):
     """
 
     rjson = {
-        'ccount': len(controller),
-        'controller': controller
+        'ccount': len(registry.controllers),
+        'controller': list(registry.controllers.values()),
+        'pixel_stripes': list(registry.pixel_stripes.values())
     }
 
     return rjson
 
 
-@dispatcher.add_method
+@rpc_method
 def test_channel(**kwargs):
     """
     Part of the Color API. Used to test a channel on a specified controller.
@@ -343,66 +936,311 @@ def test_channel(**kwargs):
     if "cid" not in kwargs or "channel" not in kwargs or "value" not in kwargs:
         return JSONRPCInvalidParams()
 
-    contr = get_controller(kwargs['cid'])
-    """ :type : ledd.controller.Controller """
+    contr = registry.get_controller(kwargs['cid'])
 
     if contr is not None:
         try:
             contr.set_channel(kwargs['channel'], kwargs['value'], 2.8)
         except OSError as e:
-            return JSONRPCError(-1009, "Internal Error", e)
+            return JSONRPCError(-1009, "Internal Error", str(e))
     else:
         return JSONRPCError(-1002, "Controller not found")
 
     return ""
 
 
-@dispatcher.add_method
-def discover(**kwargs):
+@rpc_method
+def subscribe(**kwargs):
     """
-    Part of the Color API. Used by mobile applications to find the controller.
+    Part of the Color API. Used to get notified about changes over the current connection.
+    Notifications are JSON-RPC requests without id, named <topic>_changed. Changes of the same object are
+    coalesced, only the latest state is sent, at most rate times per second.
+    Optional parameters: topics: list out of color, effect, controller (default all); rate (default 10)
+    """
+
+    topics = kwargs.get('topics', TOPICS)
+    rate = kwargs.get('rate', 10.0)
+
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not math.isfinite(rate) or rate <= 0:
+        return JSONRPCInvalidParams()
+
+    if current_connection is None:
+        return JSONRPCError(-1009, "Internal Error")
+
+    try:
+        subscriber = hub.subscribe(current_connection, topics, float(rate))
+    except (TypeError, ValueError):
+        return JSONRPCInvalidParams()
+
+    return {'topics': sorted(subscriber.topics), 'rate': subscriber.rate}
+
+
+@rpc_method
+def unsubscribe(**kwargs):
+    """
+    Part of the Color API. Used to stop notifications on the current connection.
     Required parameters: -
     """
 
-    return {'version': VERSION}
+    if current_connection is not None:
+        hub.unsubscribe(current_connection)
+
+    return ""
+
+
+@rpc_method
+def claim_stripes(**kwargs):
+    """
+    Part of the Color API. Used to drive stripes through the memory mapped framebuffer (see ledd.framebuffer) instead
+    of set_color. Colors written to the slots of the stripes are picked up with every frame and override effects,
+    until the stripes are released or the connection is closed.
+    Required parameters: stripe IDs: sids
+    """
+
+    if "sids" not in kwargs:
+        return JSONRPCInvalidParams()
+
+    if framebuffer is None:
+        return JSONRPCError(-1012, "Framebuffer disabled")
+
+    if current_connection is None:
+        return JSONRPCError(-1009, "Internal Error")
+
+    sstripes = registry.find_stripes(kwargs['sids'])
+
+    if not sstripes:
+        return JSONRPCError(-1003, "Stripeid not found")
+
+    for stripe in sstripes:
+        if not stripe.id < framebuffer.slots:
+            return JSONRPCError(-1013, "No framebuffer slot for stripe")
+        if framebuffer.claims.get(stripe.id, current_connection) is not current_connection:
+            return JSONRPCError(-1014, "Stripe already claimed")
+
+    for stripe in sstripes:
+        framebuffer.claim(stripe.id, current_connection)
+        scheduler.cancel(('stripe', stripe.id))
+
+    if poll_framebuffer not in scheduler.sources:
+        scheduler.sources.append(poll_framebuffer)
+        scheduler.wake()
+
+    return {'path': framebuffer.path, 'sids': [stripe.id for stripe in sstripes]}
+
+
+@rpc_method
+def release_stripes(**kwargs):
+    """
+    Part of the Color API. Used to hand stripes claimed by this connection back to the daemon. They keep their last
+    color.
+    Required parameters: stripe IDs: sids
+    """
+
+    if "sids" not in kwargs or not isinstance(kwargs['sids'], list):
+        return JSONRPCInvalidParams()
+
+    if framebuffer is not None:
+        for sid in kwargs['sids']:
+            if framebuffer.claims.get(sid) is current_connection:
+                framebuffer.release(sid)
+        release_framebuffer()
+
+    return ""
 
 
-def get_stripe(sid):
-    for s in stripes:
-        if s.id == sid:
-            return s
+def poll_framebuffer():
+    """
+    Source of the render clock while stripes are claimed. The last color of every claimed stripe is staged again
+    with each frame, so it stays on top of running effects.
+    """
+    framebuffer.poll()
+    colors = []
+    for sid, color in framebuffer.colors.items():
+        stripe = registry.get_stripe(sid)
+        if stripe is not None:
+            colors.append((stripe, color))
+    return colors
 
 
-def get_controller(cid):
-    for c in controller:
-        if c.id == cid:
-            return c
+def release_framebuffer(owner=None):
+    """
+    Releases the stripes of a closed connection and stops polling once nothing is claimed anymore.
+    """
+    if owner is not None:
+        framebuffer.release_owner(owner)
+    if not framebuffer.claims and poll_framebuffer in scheduler.sources:
+        scheduler.sources.remove(poll_framebuffer)
+
+
+@rpc_method
+def discover(**kwargs):
+    """
+    Part of the Color API. Used by mobile applications to find the controller.
+    Required parameters: -
+    """
+
+    return {'version': VERSION}
 
 
 class LedDProtocol(asyncio.Protocol):
+    """
+    JSON-RPC over TCP. Requests and responses are separated by newlines; requests may be pipelined and split
+    across packets arbitrarily. JSON-RPC batch arrays are supported. All responses to one read are sent with a
+    single write, and reading pauses while the transport's write buffer is full.
+    """
     transport = None
+    max_request_size = 1024 * 1024
+    write_buffer_high = 256 * 1024
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.paused = False
 
     def connection_made(self, transport):
         log.debug("New connection from %s", transport.get_extra_info("peername"))
         self.transport = transport
+        transport.set_write_buffer_limits(high=self.write_buffer_high)
 
     def data_received(self, data):
+        self.buffer.extend(data)
+        self.process()
+
+    def process(self):
+        responses = []
+
+        while not self.paused:
+            line = self.next_request()
+            if line is None:
+                break
+
+            response = self.select_task(line)
+            if response:
+                responses.append(response)
+
+        if responses:
+            self.transport.write(b"".join(responses))
+
+    def next_request(self):
+        """
+        Cuts the next complete request out of the buffer.
+        :rtype: bytes
+        """
+        i = self.buffer.find(b"\n")
+
+        if i < 0:
+            if len(self.buffer) > self.max_request_size:
+                log.warning("Request from %s exceeds %s bytes, closing connection",
+                            self.transport.get_extra_info("peername"), self.max_request_size)
+                self.buffer.clear()
+                self.transport.close()
+            elif self.is_unterminated_request():
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line
+            return None
+
+        line = bytes(self.buffer[:i])
+        del self.buffer[:i + 1]
+        return line
+
+    def is_unterminated_request(self):
+        """
+        Older clients send a single request without a trailing newline. Accept the buffer if it is a complete
+        JSON object or array by itself.
+        """
+        if not self.buffer.rstrip().endswith((b"}", b"]")):
+            return False
+
+        try:
+            return isinstance(json.loads(self.buffer.decode()), (dict, list))
+        except ValueError:
+            return False
+
+    def select_task(self, line):
+        """
+        Handles one request line.
+        :return: the encoded, newline terminated response or None for notifications
+        :rtype: bytes
+        """
         try:
-            d_decoded = data.decode()
+            line = line.decode().strip()
         except UnicodeDecodeError:
             log.warning("Recieved undecodable data, ignoring")
-        else:
-            self.select_task(d_decoded)
-
-    def select_task(self, data):
-        if data:
-            data_split = data.splitlines()
-            for line in data_split:
-                if line:
-                    try:
-                        self.transport.write(JSONRPCResponseManager.handle(line, dispatcher).json.encode())
-                    except TypeError as te:
-                        log.warning("Can't send response: %s", te)
+            return None
+
+        if not line:
+            return None
+
+        global current_connection
+        current_connection = self
+        try:
+            response = JSONRPCResponseManager.handle(line, dispatcher)
+        finally:
+            current_connection = None
+
+        if response is None:
+            return None
+
+        try:
+            return response.json.encode() + b"\n"
+        except TypeError:
+            # every request gets an answer, a client pipelining requests would wait for this one forever
+            for single in getattr(response, 'responses', (response,)):
+                try:
+                    json.dumps(single.data)
+                except TypeError as te:
+                    log.warning("Can't send response: %s", te)
+                    single.data = {'id': single._id, 'error': JSONRPCInternalError(data=str(te))._data}
+            return response.json.encode() + b"\n"
+
+    def pause_writing(self):
+        self.paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self.transport.resume_reading()
+        self.process()
 
     def connection_lost(self, exc):
+        if hub is not None:
+            hub.unsubscribe(self)
+        if framebuffer is not None:
+            release_framebuffer(self)
         log.info("Lost connection to %s", self.transport.get_extra_info("peername"))
+
+
+class LedDDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Receives binary frames (see ledd.udpframe) from real-time sources. Colors are staged on the render clock and
+    written with its next frame. Datagrams older than the last one of the same sender are dropped.
+    """
+
+    def __init__(self):
+        self.sequences = {}
+        self.received = 0
+        self.dropped = 0
+
+    def datagram_received(self, data, addr):
+        try:
+            seq, colors = decode_frame(data)
+        except ValueError as e:
+            log.debug("Invalid frame from %s: %s", addr, e)
+            self.dropped += 1
+            return
+
+        last = self.sequences.get(addr)
+        if last is not None and not is_newer(seq, last):
+            self.dropped += 1
+            return
+
+        self.sequences[addr] = seq
+        self.received += 1
+
+        for sid, color in colors:
+            stripe = registry.get_stripe(sid)
+            if stripe is not None:
+                scheduler.stage(stripe, color)
+
+    def error_received(self, exc):
+        log.warning("UDP error: %s", exc)
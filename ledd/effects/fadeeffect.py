@@ -14,8 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import spectra
-
+from ledd.color import HSV
 from ledd.effects.generatoreffect import GeneratorEffect
 
 
@@ -25,11 +24,12 @@ class FadeEffect(GeneratorEffect):
 
     name = "Fade Effect"
     description = "Fades through the HSV color wheel"
+    color_space = HSV
+    periodic = True
+    period = 20000
 
     def execute(self):
-        scale = spectra.scale([spectra.hsv(0.0, 1.0, 1.0), spectra.hsv(360.0, 1.0, 1.0)]).domain([0, 20000])
-
         i = 0
         while True:
-            yield scale(i)
-            i = (i + 1) % 20000
+            yield i * 360.0 / self.period, 1.0, 1.0
+            i = (i + 1) % self.period
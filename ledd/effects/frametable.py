@@ -0,0 +1,158 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+from ledd.color import HSV, hsv_to_rgb
+
+log = logging.getLogger(__name__)
+
+
+class FrameTable(object):
+    """
+    One period of a baked effect as a flat array of r, g, b floats.
+    """
+
+    def __init__(self, data):
+        """
+        :type data: array.array
+        """
+        self.data = data
+        self.frames = len(data) // 3
+
+    def __len__(self):
+        return self.frames
+
+    @property
+    def nbytes(self):
+        return len(self.data) * self.data.itemsize
+
+    def frame(self, i):
+        i *= 3
+        return self.data[i], self.data[i + 1], self.data[i + 2]
+
+
+class FrameTableCache(object):
+    """
+    Baked frame tables of periodic, deterministic effects, keyed by effect class and options.
+    Stacks running the same effect with the same options share one table. The least recently used tables are
+    dropped once the total size exceeds max_bytes; stacks still holding them keep working.
+    Tables are recorded from the frames the first stack renders anyway, so starting an effect never stalls the
+    event loop with baking a whole period. Render workers add tables, the cache is locked.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(effect):
+        return type(effect), json.dumps(effect.options, sort_keys=True)
+
+    def get(self, effect):
+        """
+        :type effect: ledd.effects.generatoreffect.GeneratorEffect
+        :return: the frame table of the effect, None if it has not been recorded yet
+        :rtype: FrameTable
+        """
+        key = self.key(effect)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is None:
+                self.misses += 1
+                return None
+
+            self._tables.move_to_end(key)
+            self.hits += 1
+            return table
+
+    def record(self, effect):
+        """
+        :type effect: ledd.effects.generatoreffect.GeneratorEffect
+        :return: a recorder for the frames of the effect, which has to be a fresh instance, None if its table would
+                 exceed the size limit
+        :rtype: FrameRecorder
+        """
+        if effect.period * 3 * array('f').itemsize > self.max_bytes:
+            log.info("%s is too large to bake (%s frames)", effect.name, effect.period)
+            return None
+        return FrameRecorder(self, effect)
+
+    def add(self, key, data):
+        """
+        Adds a recorded table, a table recorded meanwhile by another stack is kept.
+        :rtype: FrameTable
+        """
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                return table
+
+            table = self._tables[key] = FrameTable(data)
+            self.nbytes += table.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._tables.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+            return table
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.nbytes = 0
+
+
+class FrameRecorder(object):
+    """
+    Bakes the frame table of an effect from one period of its rendered frames, converted to rgb.
+    """
+
+    def __init__(self, cache, effect):
+        """
+        :type cache: FrameTableCache
+        :type effect: ledd.effects.generatoreffect.GeneratorEffect
+        """
+        self.cache = cache
+        self.key = cache.key(effect)
+        self.name = effect.name
+        self.size = 3 * effect.period
+        self.hsv = effect.color_space == HSV
+        self.data = array('f')
+
+    def add(self, color):
+        """
+        Records the next frame.
+        :return: the table once a whole period is recorded, None before
+        :rtype: FrameTable
+        """
+        self.data.extend(hsv_to_rgb(*color) if self.hsv else color)
+        if len(self.data) < self.size:
+            return None
+
+        log.debug("Baked %s: %s frames", self.name, self.size // 3)
+        return self.cache.add(self.key, self.data)
+
+
+frame_tables = FrameTableCache()
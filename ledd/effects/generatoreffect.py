@@ -14,21 +14,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from spectra import Color
-
+from ledd.color import RGB
 from ledd.effects.baseeffect import BaseEffect
 
 
 class GeneratorEffect(BaseEffect):
     """
     This is a base class for simple effects.
-    It should yield a new color on each execution.
+    It should yield a new color on each execution, as a tuple in the color space set in color_space.
+
+    Effects whose output only depends on their options and repeats after period frames can set periodic, they are
+    then recorded into a shared frame table during their first period and played back from it.
     """
+    color_space = RGB
+    periodic = False
+    period = None
 
-    def __init__(self):
+    def __init__(self, options=None):
         """
         Do not override, use setup instead.
+        :type options: dict
         """
+        self.options = options or {}
         self.generator = self.execute()
 
     def setup(self):
@@ -36,7 +43,12 @@ class GeneratorEffect(BaseEffect):
 
     def execute_internal(self):
         c = next(self.generator)
-        assert isinstance(c, Color)
+
+        # effects yielding spectra colors still work, at the cost of a conversion per frame
+        if hasattr(c, "clamped_rgb"):
+            return c.clamped_rgb
+
+        assert len(c) == 3
         return c
 
     def execute(self):
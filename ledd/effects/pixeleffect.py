@@ -0,0 +1,56 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from ledd.color import PIXELS
+from ledd.effects.baseeffect import BaseEffect
+
+
+class PixelEffect(BaseEffect):
+    """
+    This is a base class for effects on pixel stripes.
+    Instead of one color per frame, render fills a whole frame buffer of 8 bit r, g, b triples. Effects should write
+    it with slice assignments or bytes operations, a Python loop per pixel is too slow for long stripes.
+    """
+    color_space = PIXELS
+    periodic = False
+
+    def __init__(self, options=None):
+        """
+        Do not override, use setup instead.
+        :type options: dict
+        """
+        self.options = options or {}
+        self.pixels = 0
+
+    def resize(self, pixels):
+        """
+        Called before the first frame and whenever the longest stripe of the effect changes.
+        """
+        self.pixels = pixels
+        self.setup()
+
+    def setup(self):
+        pass
+
+    def render(self, buffer, frame):
+        """
+        :param buffer: bytearray of 3 * pixels bytes, holding the previous frame
+        :param frame: number of the frame, counting from 0
+        """
+        pass
+
+    def tear_down(self):
+        pass
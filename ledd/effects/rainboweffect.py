@@ -0,0 +1,40 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from ledd.color import hsv_to_rgb
+from ledd.effects.pixeleffect import PixelEffect
+
+
+class RainbowEffect(PixelEffect):
+    author = "LeDD-Freaks"
+    version = "0.1"
+
+    name = "Rainbow Effect"
+    description = "Moves the HSV color wheel along a pixel stripe"
+
+    def setup(self):
+        # the wheel is rendered once and repeated past the end of the stripe, so every frame is a single slice of it
+        length = max(int(self.options.get('length', self.pixels)), 1)
+        self.step = int(self.options.get('speed', 1))
+        wheel = bytearray()
+        for i in range(length):
+            wheel.extend(int(c * 255 + 0.5) for c in hsv_to_rgb(i * 360.0 / length, 1.0, 1.0))
+        self.length = length
+        self.wheel = wheel * (self.pixels // length + 2)
+
+    def render(self, buffer, frame):
+        offset = 3 * (frame * self.step % self.length)
+        buffer[:] = self.wheel[offset:offset + len(buffer)]
@@ -14,26 +14,216 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncio
+import time
+import uuid
 
+from ledd import profiling
+from ledd.color import RGB, HSV, PIXELS, hsv_to_rgb
 from ledd.effects.fadeeffect import FadeEffect
+from ledd.effects.frametable import frame_tables
+from ledd.modifiers import Modifiers, transform
 
 
 class EffectStack(object):
-    def __init__(self):
+    def __init__(self, effect=None):
+        """
+        :type effect: ledd.effects.generatoreffect.GeneratorEffect
+        """
+        self.eident = None
         self.stripes = []
-        self.effect = FadeEffect()
-        # TODO
-        self.modifiers = []
+        self.effect = effect if effect is not None else FadeEffect()
+        self.table = frame_tables.get(self.effect) if self.effect.periodic else None
+        """ :type : ledd.effects.frametable.FrameTable """
+        self._recorder = frame_tables.record(self.effect) if self.effect.periodic and self.table is None else None
+        self.index = 0
+        self.modifiers = Modifiers()
+        """ modifiers of this stack only, fused with the global ones by the FrameScheduler """
 
-    def start(self):
-        asyncio.get_event_loop().call_soon(self.execute)
+    @property
+    def color_space(self):
+        return RGB if self.table is not None else self.effect.color_space
 
     def execute(self):
+        color = self.render()
+        if self.color_space == HSV:
+            color = hsv_to_rgb(*color)
+        self.apply(color)
+
+    def render(self):
+        """
+        Computes the color of the next frame without touching any hardware.
+        :return: color tuple in color_space
+        """
+        session = profiling.session
+        if session is not None:
+            started = time.perf_counter()
+            color = self._render()
+            session.attribute(type(self.effect), time.perf_counter() - started)
+            return color
+
+        return self._render()
+
+    def _render(self):
+        if self.table is not None:
+            color = self.table.frame(self.index)
+            self.index = (self.index + 1) % self.table.frames
+            return color
+
         color = self.effect.execute_internal()
+        if self._recorder is not None:
+            table = self._recorder.add(color)
+            if table is not None:
+                # a whole period is recorded, this frame is returned in rgb like all following ones from the table
+                self._recorder = None
+                self.table = table
+                self.index = 0
+                return table.frame(table.frames - 1)
+        return color
+
+    def apply(self, color, matrix=None):
+        """
+        Stages a rendered rgb color on all stripes. The FrameScheduler commits the controllers afterwards.
+        :param matrix: fused modifiers, applied once for all stripes
+        """
+        output = transform(matrix, color) if matrix is not None else None
+        for stripe in self.stripes:
+            stripe.set_color(color, output)
+
+    def to_json(self):
+        return {
+            'eident': self.eident,
+            'name': self.effect.name,
+            'sids': [stripe.id for stripe in self.stripes],
+            'eopt': self.effect.options,
+            'modifiers': self.modifiers.to_json()
+        }
+
+
+class PixelStack(object):
+    """
+    Runs a pixel effect on a group of pixel stripes. Frames are rendered for the longest stripe, shorter ones show
+    its beginning.
+    """
+    color_space = PIXELS
+
+    def __init__(self, effect):
+        """
+        :type effect: ledd.effects.pixeleffect.PixelEffect
+        """
+        self.eident = None
+        self.stripes = []
+        """ :type : list[ledd.pixelstripe.PixelStripe] """
+        self.effect = effect
+        self.index = 0
+        self.buffer = bytearray()
+        self.modifiers = Modifiers()
+
+    def render(self):
+        """
+        :return: frame of the longest stripe as bytes, so it can be flushed while the next one is rendered
+        """
+        pixels = max((stripe.pixels for stripe in self.stripes), default=0)
+        if 3 * pixels != len(self.buffer):
+            self.buffer = bytearray(3 * pixels)
+            self.effect.resize(pixels)
+
+        session = profiling.session
+        started = time.perf_counter() if session is not None else None
+
+        self.effect.render(self.buffer, self.index)
+        self.index += 1
+
+        if session is not None:
+            session.attribute(type(self.effect), time.perf_counter() - started)
+        return bytes(self.buffer)
 
+    def apply(self, frame, gains=None):
+        """
+        :param gains: fused channel gains of the modifiers
+        """
         for stripe in self.stripes:
-            stripe.set_color(color)
+            stripe.show(frame, gains)
+
+    def to_json(self):
+        return {
+            'eident': self.eident,
+            'name': self.effect.name,
+            'sids': [stripe.id for stripe in self.stripes],
+            'eopt': self.effect.options,
+            'modifiers': self.modifiers.to_json()
+        }
+
+
+class EffectRegistry(object):
+    """
+    Running effects by their eident. Each running effect is one EffectStack that renders a frame once for its whole
+    group of stripes. A stripe runs at most one effect, starting another one takes it out of its previous group.
+    """
+
+    def __init__(self, scheduler):
+        """
+        :type scheduler: ledd.scheduler.FrameScheduler
+        """
+        self.scheduler = scheduler
+        self._stacks = {}
+        """ :type : dict[str, EffectStack] """
+        self._by_stripe = {}
+
+    def __len__(self):
+        return len(self._stacks)
+
+    def __iter__(self):
+        return iter(self._stacks.values())
+
+    def start(self, stack):
+        """
+        Registers the stack and hands it to the render clock.
+        :type stack: EffectStack
+        :return: eident of the running effect
+        """
+        for stripe in stack.stripes:
+            self._detach(stripe)
+
+        stack.eident = uuid.uuid4().hex
+        self._stacks[stack.eident] = stack
+        for stripe in stack.stripes:
+            self._by_stripe[stripe.id] = stack.eident
+
+        self.scheduler.add(stack)
+        return stack.eident
+
+    def stop(self, eident):
+        """
+        :return: the stopped stack or None if no effect is running as eident
+        :rtype: EffectStack
+        """
+        stack = self._stacks.pop(eident, None)
+        if stack is None:
+            return None
+
+        self.scheduler.remove(stack)
+        for stripe in stack.stripes:
+            self._by_stripe.pop(stripe.id, None)
+        stack.effect.tear_down()
+        return stack
+
+    def get(self, eident):
+        return self._stacks.get(eident)
+
+    def for_stripe(self, sid):
+        """
+        :return: the stack currently driving the stripe, if any
+        """
+        eident = self._by_stripe.get(sid)
+        return self._stacks.get(eident) if eident is not None else None
+
+    def _detach(self, stripe):
+        stack = self.for_stripe(stripe.id)
+        if stack is None:
+            return
 
-        # schedule next execution
-        asyncio.get_event_loop().call_later(0.1, self.execute)
+        # rebind instead of removing in place, a render worker may be iterating the list
+        stack.stripes = [s for s in stack.stripes if s is not stripe]
+        del self._by_stripe[stripe.id]
+        if not stack.stripes:
+            self.stop(stack.eident)
@@ -0,0 +1,169 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory mapped framebuffer for local real-time sources.
+
+The file starts with a header of the magic b"LDFB", a 16 bit version, the 16 bit number of slots and the 32 bit size
+of a slot. Slot n belongs to the stripe with id n and holds a 32 bit generation, a 32 bit claimed flag written by the
+daemon and 16 bit red, green and blue values. All numbers are unsigned and little endian.
+
+A producer sets the colors of a slot like a seqlock: it increments the generation to an odd value, writes the colors
+and increments it again. The daemon only picks up slots of claimed stripes whose generation is even and changed since
+the last tick, a torn read is retried with the next tick.
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"LDFB"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+SLOT = struct.Struct("<IIHHH2x")
+GENERATION = struct.Struct("<I")
+COLOR = struct.Struct("<HHH")
+COLOR_OFFSET = 8
+CLAIMED_OFFSET = 4
+MAXVAL = 0xFFFF
+
+
+def slot_offset(sid):
+    return HEADER.size + sid * SLOT.size
+
+
+class FrameBuffer(object):
+    """
+    Daemon side of the framebuffer. Stripes are claimed for a connection and polled on the render clock.
+    """
+
+    def __init__(self, path, slots=256):
+        """
+        :param path: file to map, best on a tmpfs like /dev/shm
+        :param slots: number of slots, the highest stripe id that can be claimed is slots - 1
+        """
+        if not 0 < slots <= 0xFFFF:
+            raise ValueError("Invalid number of slots: {}".format(slots))
+
+        self.path = path
+        self.slots = slots
+        self.claims = {}
+        """ owner per claimed stripe id """
+        self.colors = {}
+        """ last color picked up per claimed stripe id """
+        self.updates = 0
+        self.torn = 0
+        self._seen = {}
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o660)
+        try:
+            os.ftruncate(fd, slot_offset(slots))
+            self._map = mmap.mmap(fd, slot_offset(slots))
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, slots, SLOT.size)
+
+    def claim(self, sid, owner):
+        """
+        Hands a stripe over to the producers of the framebuffer. Only colors written after the claim are picked up.
+        :raises IndexError: if the stripe id has no slot
+        """
+        if not 0 <= sid < self.slots:
+            raise IndexError("No slot for stripe {}".format(sid))
+
+        self.claims[sid] = owner
+        self._seen[sid] = GENERATION.unpack_from(self._map, slot_offset(sid))[0]
+        GENERATION.pack_into(self._map, slot_offset(sid) + CLAIMED_OFFSET, 1)
+
+    def release(self, sid):
+        if self.claims.pop(sid, None) is not None:
+            del self._seen[sid]
+            self.colors.pop(sid, None)
+            GENERATION.pack_into(self._map, slot_offset(sid) + CLAIMED_OFFSET, 0)
+
+    def release_owner(self, owner):
+        for sid in [sid for sid, o in self.claims.items() if o is owner]:
+            self.release(sid)
+
+    def poll(self):
+        """
+        :return: list of (stripe id, (r, g, b)) of the claimed slots written since the last poll, with components in
+                 [0, 1]
+        """
+        colors = []
+        for sid, seen in self._seen.items():
+            offset = slot_offset(sid)
+            generation = GENERATION.unpack_from(self._map, offset)[0]
+            if generation == seen:
+                continue
+
+            r, g, b = COLOR.unpack_from(self._map, offset + COLOR_OFFSET)
+            if generation & 1 or GENERATION.unpack_from(self._map, offset)[0] != generation:
+                # the producer is writing this slot right now
+                self.torn += 1
+                continue
+
+            self._seen[sid] = generation
+            self.colors[sid] = (r / MAXVAL, g / MAXVAL, b / MAXVAL)
+            colors.append((sid, self.colors[sid]))
+
+        self.updates += len(colors)
+        return colors
+
+    def close(self):
+        self._map.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FrameBufferWriter(object):
+    """
+    Producer side of the framebuffer. Each slot must only be written by one producer.
+    """
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        magic, version, self.slots, slot_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT.size:
+            self._map.close()
+            raise ValueError("Not a framebuffer of version {}: {}".format(VERSION, path))
+
+    def claimed(self, sid):
+        return GENERATION.unpack_from(self._map, slot_offset(sid) + CLAIMED_OFFSET)[0] != 0
+
+    def write(self, sid, rgb):
+        """
+        :param rgb: (r, g, b) with components in [0, 1]
+        """
+        offset = slot_offset(sid)
+        generation = GENERATION.unpack_from(self._map, offset)[0]
+        GENERATION.pack_into(self._map, offset, (generation + 1) & 0xFFFFFFFF | 1)
+        COLOR.pack_into(self._map, offset + COLOR_OFFSET,
+                        *(int(min(max(c, 0.0), 1.0) * MAXVAL + 0.5) for c in rgb))
+        GENERATION.pack_into(self._map, offset, (generation + 2) & 0xFFFFFFFF & ~1)
+
+    def close(self):
+        self._map.close()
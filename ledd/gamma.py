@@ -0,0 +1,38 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+
+DEFAULT_GAMMA = 2.8
+MAXVAL = 4095
+
+
+def gamma_correct(gamma, val, maxval):
+    return int(pow(float(val) / float(maxval), float(gamma)) * float(maxval) + 0.5)
+
+
+@lru_cache(maxsize=64)
+def gamma_table(gamma):
+    """
+    Lookup table mapping every linear 12 bit value to its gamma corrected value.
+    Tables are cached per gamma, so all channels with the same gamma share one.
+    :type gamma: float
+    :rtype: tuple
+    """
+    if gamma is None:
+        gamma = DEFAULT_GAMMA
+
+    return tuple(gamma_correct(gamma, val, MAXVAL) for val in range(MAXVAL + 1))
@@ -0,0 +1,261 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# SMBus block transfers carry at most 32 bytes
+I2C_BLOCK_MAX = 32
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+def get_bus(device):
+    """
+    Returns the shared worker of /dev/i2c-<device>, opening the bus on first use.
+    Every call has to be paired with a close() of the returned bus.
+    :type device: int
+    :rtype: I2CBus
+    """
+    with _buses_lock:
+        bus = _buses.get(device)
+        if bus is None:
+            bus = _buses[device] = bus_type(device)
+        bus.users += 1
+        return bus
+
+
+def release(bus):
+    """
+    Drops one user of a bus.
+    :return: whether that was the last user, who has to close the device
+    :rtype: bool
+    """
+    with _buses_lock:
+        bus.users -= 1
+        if bus.users > 0:
+            return False
+        _buses.pop(bus.device, None)
+        return True
+
+
+class I2CBus(object):
+    """
+    Owns the file descriptor of one physical I2C bus and is shared by all controllers on it.
+
+    Block writes are queued per register and written by a worker thread, merged into as few block transfers as
+    possible. A register queued again before the worker got to it is only written once, with the latest value.
+    All other operations are executed synchronously after the queue has been written, so they keep their order
+    relative to queued writes.
+    """
+
+    def __init__(self, device):
+        import smbus
+
+        self.device = device
+        self.users = 0
+        self.transactions = 0
+        self.bytes = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.by_address = {}
+        """ transactions, bytes and errors per device address, :type : dict[int, dict[str, int]] """
+        self._smbus = smbus.SMBus(device)
+        self._pending = {}
+        """ :type : dict[(int, int), int] """
+        self._error_handlers = {}
+        self._io_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="i2c-{}".format(device), daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<I2CBus device={} users={}>".format(self.device, self.users)
+
+    def set_error_handler(self, address, handler):
+        """
+        Registers a callable that gets the OSError of a failed queued write to the given address.
+        """
+        self._error_handlers[address] = handler
+
+    def remove_error_handler(self, address, handler):
+        """
+        Unregisters the error handler of the given address, unless another one was registered meanwhile.
+        """
+        if self._error_handlers.get(address) == handler:
+            del self._error_handlers[address]
+
+    def write_i2c_block_data(self, address, register, data):
+        with self._cond:
+            for i, value in enumerate(data):
+                if (address, register + i) in self._pending:
+                    self.coalesced += 1
+                self._pending[(address, register + i)] = value
+            self.queued += len(data)
+            self._cond.notify()
+
+    def write_byte_data(self, address, register, value):
+        self._call(address, 1, self._smbus.write_byte_data, register, value)
+
+    def write_word_data(self, address, register, value):
+        self._call(address, 2, self._smbus.write_word_data, register, value)
+
+    def read_byte_data(self, address, register):
+        return self._call(address, 1, self._smbus.read_byte_data, register)
+
+    def read_word_data(self, address, register):
+        return self._call(address, 2, self._smbus.read_word_data, register)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._call(address, length, self._smbus.read_i2c_block_data, register, length)
+
+    def _call(self, address, nbytes, operation, *args):
+        """
+        Executes a synchronous operation after the queue has been written.
+        """
+        failures = []
+        try:
+            with self._io_lock:
+                failures = self._write_pending()
+                try:
+                    result = operation(address, *args)
+                except OSError:
+                    self._count_error(address)
+                    raise
+                self._count(address, nbytes)
+                return result
+        finally:
+            self._report(failures)
+
+    def flush(self):
+        """
+        Writes all queued registers before returning.
+        """
+        with self._io_lock:
+            failures = self._write_pending()
+        self._report(failures)
+
+    def close(self):
+        """
+        Releases the bus. The last user writes out the queue and closes the device.
+        """
+        if not release(self):
+            return
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._smbus.close()
+
+    @property
+    def stats(self):
+        return {
+            'device': self.device,
+            'transactions': self.transactions,
+            'bytes': self.bytes,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'errors': self.errors
+        }
+
+    def _count(self, address, nbytes):
+        self.transactions += 1
+        self.bytes += nbytes
+        counters = self._counters(address)
+        counters['transactions'] += 1
+        counters['bytes'] += nbytes
+
+    def _count_error(self, address):
+        self.errors += 1
+        self._counters(address)['errors'] += 1
+
+    def _counters(self, address):
+        counters = self.by_address.get(address)
+        if counters is None:
+            counters = self.by_address[address] = {'transactions': 0, 'bytes': 0, 'errors': 0}
+        return counters
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+
+            with self._io_lock:
+                failures = self._write_pending()
+            self._report(failures)
+
+    def _write_pending(self):
+        """
+        Writes the queue as contiguous block transfers. Must be called with the io lock held.
+        :return: (address, OSError) of the failed writes, to be reported once the io lock is released
+        :rtype: list[(int, OSError)]
+        """
+        with self._cond:
+            pending, self._pending = self._pending, {}
+
+        failed = {}
+        for address, register, data in self._blocks(pending):
+            if address in failed:
+                continue
+            try:
+                self._smbus.write_i2c_block_data(address, register, data)
+                self._count(address, len(data))
+            except OSError as e:
+                self._count_error(address)
+                failed[address] = e
+        return list(failed.items())
+
+    def _report(self, failures):
+        """
+        Hands failed writes to the error handlers. Never called with the io lock held, the handlers take the lock
+        of their controller, which is held by callers waiting for the io lock.
+        """
+        for address, e in failures:
+            handler = self._error_handlers.get(address)
+            if handler is not None:
+                handler(e)
+            else:
+                log.warning("Writing to %s on i2c-%s failed: %s", hex(address), self.device, e)
+
+    @staticmethod
+    def _blocks(pending):
+        """
+        Merges queued registers into (address, first register, data) transfers of at most I2C_BLOCK_MAX bytes.
+        """
+        block = None
+        for address, register in sorted(pending):
+            if block is not None and block[0] == address and block[1] + len(block[2]) == register \
+                    and len(block[2]) < I2C_BLOCK_MAX:
+                block[2].append(pending[(address, register)])
+            else:
+                if block is not None:
+                    yield block
+                block = (address, register, [pending[(address, register)]])
+        if block is not None:
+            yield block
+
+
+bus_type = I2CBus
+""" opens the buses returned by get_bus, ledd.procbus.ProcessBus moves every bus into a process of its own """
@@ -14,7 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import String, Column
+from sqlalchemy import String, Column, Integer, Float, ForeignKey
 
 from . import Base
 
@@ -27,3 +27,26 @@ class Meta(Base):
     @classmethod
     def get_version(cls):
         return cls.query.filter(Meta.option == "db_version").first()
+
+
+class StripeState(Base):
+    """
+    Last known output of a stripe, written behind by the daemon so a restart can restore it without reading the bus.
+    """
+    __tablename__ = "stripe_state"
+    stripe_id = Column(Integer, ForeignKey('stripe.id'), primary_key=True)
+    color_r = Column(Float)
+    color_g = Column(Float)
+    color_b = Column(Float)
+    effect = Column(String)
+    effect_options = Column(String)
+
+    @property
+    def color(self):
+        if self.color_r is None:
+            return None
+        return self.color_r, self.color_g, self.color_b
+
+    @color.setter
+    def color(self, c):
+        self.color_r, self.color_g, self.color_b = c if c is not None else (None, None, None)
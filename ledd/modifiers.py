@@ -0,0 +1,181 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Modifiers change the rendered colors before they are written: brightness, color temperature and saturation.
+Each set of modifiers compiles into one 3x3 rgb matrix, the global modifiers and those of an effect stack are fused into
+a single matrix, so every color of a frame is transformed once no matter how many modifiers are set. Stacks are
+transformed before their color is staged on their stripes, dimming a stack of 200 stripes costs one transform.
+Matrices are flat tuples in row major order.
+"""
+
+import math
+
+IDENTITY = (1.0, 0.0, 0.0,
+            0.0, 1.0, 0.0,
+            0.0, 0.0, 1.0)
+UNITY = (1.0, 1.0, 1.0)
+LUMA = (0.2126, 0.7152, 0.0722)
+""" Rec. 709 weights of r, g and b, saturation keeps the luma """
+NEUTRAL_TEMPERATURE = 6500
+MIN_TEMPERATURE = 1000
+MAX_TEMPERATURE = 40000
+
+
+def blackbody(kelvin):
+    """
+    Approximate rgb of a black body, after Tanner Helland.
+    :return: (r, g, b) in [0, 255]
+    """
+    t = kelvin / 100.0
+    if t <= 66:
+        r = 255.0
+        g = 99.4708025861 * math.log(t) - 161.1195681661
+    else:
+        r = 329.698727446 * math.pow(t - 60, -0.1332047592)
+        g = 288.1221695283 * math.pow(t - 60, -0.0755148492)
+    if t >= 66:
+        b = 255.0
+    elif t <= 19:
+        b = 0.0
+    else:
+        b = 138.5177312231 * math.log(t - 10) - 305.0447927307
+    return tuple(min(max(c, 0.0), 255.0) for c in (r, g, b))
+
+
+def temperature_gains(kelvin):
+    """
+    :return: gains of r, g and b that shift white from the neutral temperature to kelvin, the largest one is 1
+    """
+    gains = [c / n for c, n in zip(blackbody(kelvin), blackbody(NEUTRAL_TEMPERATURE))]
+    top = max(gains)
+    return tuple(g / top for g in gains)
+
+
+def multiply(a, b):
+    """
+    :return: the matrix a * b, applying it is the same as applying b and then a
+    """
+    return tuple(sum(a[3 * row + k] * b[3 * k + col] for k in range(3)) for row in range(3) for col in range(3))
+
+
+def transform(matrix, rgb):
+    """
+    :rtype: tuple
+    """
+    r, g, b = rgb
+    return (matrix[0] * r + matrix[1] * g + matrix[2] * b,
+            matrix[3] * r + matrix[4] * g + matrix[5] * b,
+            matrix[6] * r + matrix[7] * g + matrix[8] * b)
+
+
+class Modifiers(object):
+    """
+    Modifier parameters of the whole daemon or of one effect stack. They can be changed while effects run, the
+    matrix is compiled again on the next update.
+    """
+
+    def __init__(self):
+        self.brightness = 1.0
+        self.temperature = NEUTRAL_TEMPERATURE
+        self.saturation = 1.0
+        self.matrix = IDENTITY
+        self.gains = UNITY
+        """ brightness and color temperature only, for outputs that can only scale their channels """
+
+    @property
+    def identity(self):
+        return self.matrix == IDENTITY
+
+    def update(self, brightness=None, temperature=None, saturation=None):
+        """
+        Parameters left at None keep their value.
+        :param brightness: factor in [0, 1]
+        :param temperature: white point in kelvin
+        :param saturation: factor in [0, 2], 0 is gray, 1 unchanged
+        :raises ValueError: if a parameter is out of range
+        """
+        brightness = self.brightness if brightness is None else float(brightness)
+        temperature = self.temperature if temperature is None else int(temperature)
+        saturation = self.saturation if saturation is None else float(saturation)
+
+        if not 0.0 <= brightness <= 1.0:
+            raise ValueError("Invalid brightness: {}".format(brightness))
+        if not MIN_TEMPERATURE <= temperature <= MAX_TEMPERATURE:
+            raise ValueError("Invalid temperature: {}".format(temperature))
+        if not 0.0 <= saturation <= 2.0:
+            raise ValueError("Invalid saturation: {}".format(saturation))
+
+        self.brightness, self.temperature, self.saturation = brightness, temperature, saturation
+        # assigned at once, render workers read the matrix and the gains without a lock
+        self.gains = self.channel_gains()
+        self.matrix = self.compile()
+
+    def compile(self):
+        """
+        :return: the matrix of saturation, then color temperature and brightness
+        """
+        if self.brightness == 1.0 and self.temperature == NEUTRAL_TEMPERATURE and self.saturation == 1.0:
+            return IDENTITY
+
+        s = self.saturation
+        saturation = tuple((1.0 - s) * LUMA[col] + (s if row == col else 0.0) for row in range(3) for col in range(3))
+        gains = self.channel_gains()
+        scale = (gains[0], 0.0, 0.0,
+                 0.0, gains[1], 0.0,
+                 0.0, 0.0, gains[2])
+        return multiply(scale, saturation)
+
+    def channel_gains(self):
+        """
+        :return: gains of r, g and b of brightness and color temperature
+        """
+        if self.brightness == 1.0 and self.temperature == NEUTRAL_TEMPERATURE:
+            return UNITY
+        return tuple(self.brightness * g for g in temperature_gains(self.temperature))
+
+    def to_json(self):
+        return {
+            'brightness': self.brightness,
+            'temperature': self.temperature,
+            'saturation': self.saturation
+        }
+
+
+def fuse(*modifiers):
+    """
+    :param modifiers: Modifiers or None, the outermost first
+    :return: matrix applying all of them, None if none of them changes a color
+    """
+    matrix = None
+    for m in modifiers:
+        if m is None or m.identity:
+            continue
+        matrix = m.matrix if matrix is None else multiply(matrix, m.matrix)
+    return matrix
+
+
+def fuse_gains(*modifiers):
+    """
+    :param modifiers: Modifiers or None
+    :return: channel gains of all of them, None if none of them scales a channel
+    """
+    gains = None
+    for m in modifiers:
+        if m is None or m.gains == UNITY:
+            continue
+        gains = m.gains if gains is None else tuple(a * b for a, b in zip(gains, m.gains))
+    return gains
@@ -0,0 +1,154 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+from collections import OrderedDict
+
+from ledd.color import rgb_to_hsv, PIXELS
+
+log = logging.getLogger(__name__)
+
+COLOR = "color"
+EFFECT = "effect"
+CONTROLLER = "controller"
+TOPICS = (COLOR, EFFECT, CONTROLLER)
+
+
+class Subscriber(object):
+    """
+    Pending notifications of one connection. Notifications with the same topic and key replace each other, so a
+    slow client gets the latest state at its rate instead of an ever growing backlog.
+    """
+
+    def __init__(self, loop, protocol, topics, rate):
+        """
+        :type loop: asyncio.BaseEventLoop
+        :type protocol: ledd.daemon.LedDProtocol
+        :param rate: maximum number of writes per second
+        """
+        self.loop = loop
+        self.protocol = protocol
+        self.topics = frozenset(topics)
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self.pending = OrderedDict()
+        self.sent = 0
+        self.coalesced = 0
+        self._last = 0.0
+        self._handle = None
+
+    def push(self, topic, key, params):
+        if (topic, key) in self.pending:
+            self.coalesced += 1
+        self.pending[(topic, key)] = params
+
+        if self._handle is None:
+            self._handle = self.loop.call_at(max(self.loop.time(), self._last + self.interval), self.flush)
+
+    def flush(self):
+        self._handle = None
+
+        if self.protocol.paused:
+            # the client doesn't keep up, keep coalescing until its buffer drained
+            self._handle = self.loop.call_later(self.interval, self.flush)
+            return
+
+        pending, self.pending = self.pending, OrderedDict()
+        self.protocol.transport.write(b"".join(
+            self.encode(topic, key, params) for (topic, key), params in pending.items()))
+        self.sent += len(pending)
+        self._last = self.loop.time()
+
+    @staticmethod
+    def encode(topic, key, params):
+        if topic == COLOR:
+            # colors are pushed as rgb and converted only when they are actually sent
+            params = {'sid': key, 'color': rgb_to_hsv(*params)}
+
+        return (json.dumps({'jsonrpc': "2.0", 'method': topic + "_changed", 'params': params}) + "\n").encode()
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class Hub(object):
+    """
+    Distributes state changes to subscribed connections.
+    """
+
+    def __init__(self, loop):
+        """
+        :type loop: asyncio.BaseEventLoop
+        """
+        self.loop = loop
+        self.subscribers = {}
+        self._by_topic = dict((topic, set()) for topic in TOPICS)
+
+    def subscribe(self, protocol, topics, rate=10.0):
+        """
+        Subscribes a connection, replacing its previous subscription.
+        :rtype: Subscriber
+        """
+        unknown = set(topics) - set(TOPICS)
+        if unknown:
+            raise ValueError("Unknown topics: {}".format(", ".join(sorted(unknown))))
+        if not 0 < rate < float('inf'):
+            raise ValueError("rate must be positive and finite: {}".format(rate))
+
+        self.unsubscribe(protocol)
+        subscriber = self.subscribers[protocol] = Subscriber(self.loop, protocol, topics, rate)
+        for topic in subscriber.topics:
+            self._by_topic[topic].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, protocol):
+        subscriber = self.subscribers.pop(protocol, None)
+        if subscriber is None:
+            return False
+
+        subscriber.cancel()
+        for topic in subscriber.topics:
+            self._by_topic[topic].discard(subscriber)
+        return True
+
+    def wants(self, topic):
+        return bool(self._by_topic[topic])
+
+    def publish(self, topic, key, params):
+        """
+        Must be called on the event loop.
+        :param key: identifies the object that changed, e.g. the stripe id
+        :param params: notification parameters; rgb tuple for colors, anything JSON serializable otherwise
+        """
+        for subscriber in self._by_topic[topic]:
+            subscriber.push(topic, key, params)
+
+    def publish_frame(self, frame):
+        """
+        Publishes the stripe colors of a rendered frame of (stack, rgb) pairs, see FrameScheduler.
+        """
+        if not self._by_topic[COLOR]:
+            return
+
+        for stack, color in frame:
+            # colors of single pixels are not published
+            if getattr(stack, 'color_space', None) == PIXELS:
+                continue
+            for stripe in stack.stripes:
+                self.publish(COLOR, stripe.id, color)
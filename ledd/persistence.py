@@ -0,0 +1,148 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import session
+from .models import StripeState
+
+log = logging.getLogger(__name__)
+
+
+class DBWorker(object):
+    """
+    Owns the database session of the daemon and runs every query and commit in its own thread,
+    so slow SD cards never stall the event loop.
+    Writes are queued (write-behind) and committed together at most every batch_delay seconds.
+    """
+
+    def __init__(self, batch_delay=0.5):
+        self.batch_delay = batch_delay
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        """
+        Queues a write, fn runs in the db thread and its changes are committed with the next batch.
+        """
+        self._queue.put((fn, args, None))
+
+    def call(self, fn, *args):
+        """
+        Runs fn in the db thread.
+        :return: future of the result of fn
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def close(self):
+        """
+        Commits all queued writes and stops the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        dirty_since = None
+        while True:
+            timeout = None if dirty_since is None else max(0.0, dirty_since + self.batch_delay - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._commit()
+                dirty_since = None
+                continue
+
+            if item is None:
+                break
+
+            fn, args, future = item
+            if future is not None:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("Queued database write failed")
+                continue
+            self.writes += 1
+            if dirty_since is None:
+                dirty_since = time.monotonic()
+            elif time.monotonic() - dirty_since >= self.batch_delay:
+                self._commit()
+                dirty_since = None
+
+        if dirty_since is not None:
+            self._commit()
+        session.remove()
+
+    def _commit(self):
+        try:
+            session.commit()
+            self.commits += 1
+        except Exception:
+            log.exception("Database commit failed; dropping %s queued writes", len(session.new) + len(session.dirty))
+            session.rollback()
+
+
+def snapshot(stripe, stack):
+    """
+    :param stack: effect group the stripe is part of, if any
+    :type stripe: ledd.stripe.Stripe
+    :type stack: ledd.effectstack.EffectStack
+    :return: persistable state of the stripe: (color, effect name, effect options)
+    :rtype: tuple
+    """
+    if stack is not None:
+        # the color changes every frame, the effect is what gets restored
+        return None, type(stack.effect).__name__, json.dumps(stack.effect.options, sort_keys=True)
+    return stripe.color, None, None
+
+
+def save_states(states):
+    """
+    Runs in the db thread.
+    :param states: snapshot per stripe id
+    :type states: dict[int, tuple]
+    """
+    for sid, (color, effect, options) in states.items():
+        state = StripeState(stripe_id=sid, effect=effect, effect_options=options)
+        state.color = color
+        session.merge(state)
+
+
+def load_states():
+    """
+    Runs in the db thread.
+    :rtype: dict[int, ledd.models.StripeState]
+    """
+    return {state.stripe_id: state for state in StripeState.query.all()}
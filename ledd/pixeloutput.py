@@ -0,0 +1,99 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Outputs of pixel stripes. Each one takes the finished bytes of a frame, already gamma corrected and in the color order
+of the chips.
+"""
+
+import fcntl
+import logging
+import os
+import struct
+
+log = logging.getLogger(__name__)
+
+SPI_IOC_WR_MAX_SPEED_HZ = 0x40046B04
+SPI_BUFSIZ = 4096
+""" default maximum transfer size of spidev """
+
+
+class SPIOutput(object):
+    """
+    Writes frames to a spidev device, as used by WS2801 and LPD8806 chips that latch after the clock idles.
+    """
+
+    def __init__(self, device, speed=None):
+        """
+        :param device: e.g. /dev/spidev0.0
+        :param speed: clock in Hz, the driver default if None
+        """
+        self.device = device
+        self._fd = os.open(device, os.O_WRONLY)
+        if speed:
+            try:
+                fcntl.ioctl(self._fd, SPI_IOC_WR_MAX_SPEED_HZ, struct.pack("I", speed))
+            except OSError as e:
+                log.warning("Can't set the clock of %s to %s Hz: %s", device, speed, e)
+
+    def write(self, data):
+        view = memoryview(data)
+        for offset in range(0, len(view), SPI_BUFSIZ):
+            os.write(self._fd, view[offset:offset + SPI_BUFSIZ])
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FileOutput(object):
+    """
+    Keeps the latest frame in a regular file, for other processes or for testing without hardware.
+    """
+
+    def __init__(self, device, speed=None):
+        self.device = device
+        self._fd = os.open(device, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def write(self, data):
+        os.pwrite(self._fd, data, 0)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class LoopbackOutput(object):
+    """
+    Keeps the latest frame in memory.
+    """
+
+    def __init__(self, device=None, speed=None):
+        self.device = device
+        self.frame = b""
+        self.frames = 0
+
+    def write(self, data):
+        self.frame = bytes(data)
+        self.frames += 1
+
+    def close(self):
+        pass
+
+
+OUTPUTS = {
+    'spi': SPIOutput,
+    'file': FileOutput,
+    'loopback': LoopbackOutput,
+}
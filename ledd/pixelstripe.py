@@ -0,0 +1,155 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy.orm import reconstructor, validates
+
+from . import Base
+from .gamma import gamma_correct, DEFAULT_GAMMA
+from .modifiers import UNITY
+from .pixeloutput import OUTPUTS
+
+log = logging.getLogger(__name__)
+
+ORDERS = ('rgb', 'rbg', 'grb', 'gbr', 'brg', 'bgr')
+
+
+def pixel_gamma_table(gamma):
+    """
+    :return: translation table for bytes.translate, mapping linear 8 bit values to gamma corrected ones
+    :rtype: bytes
+    """
+    return bytes(gamma_correct(gamma, val, 255) for val in range(256))
+
+
+class PixelStripe(Base):
+    """
+    An addressable stripe with a color per pixel. Its frames are flat bytes of r, g, b triples, gamma correction and
+    the color order of the chips are applied to the whole frame at once before it is written to the output.
+    Pixel stripes share the id space of stripes, but are driven by pixel effects only.
+    """
+    __tablename__ = "pixel_stripe"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    pixels = Column(Integer)
+    output = Column(String)
+    device = Column(String)
+    speed = Column(Integer)
+    order = Column(String, default='rgb')
+    gamma = Column(Float, default=DEFAULT_GAMMA)
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('order', 'rgb')
+        kwargs.setdefault('gamma', DEFAULT_GAMMA)
+        super().__init__(*args, **kwargs)
+        self.init_on_load()
+
+    @reconstructor
+    def init_on_load(self):
+        self.buffer = bytearray(3 * self.pixels)
+        """ linear colors of the last frame """
+        self.gamma_table = pixel_gamma_table(self.gamma)
+        self.limit = 1.0
+        """ highest level of every channel, applied after the modifiers """
+        self.frames = 0
+        self.errors = 0
+        self._output = None
+        self._tables = None
+        self._tables_key = None
+
+    @validates('order')
+    def validate_order(self, key, order):
+        if order not in ORDERS:
+            raise ValueError("Invalid color order: {}".format(order))
+        return order
+
+    @validates('gamma')
+    def validate_gamma(self, key, gamma):
+        if hasattr(self, 'gamma_table'):
+            self.gamma_table = pixel_gamma_table(gamma)
+        return gamma
+
+    def open(self):
+        """
+        :raises OSError: if the output can't be opened
+        :raises KeyError: for unknown outputs
+        """
+        self._output = OUTPUTS[self.output](self.device, self.speed)
+
+    def close(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+    def show(self, frame, gains=None):
+        """
+        Writes a frame to the output, a longer frame is cut to the length of the stripe.
+        :param frame: bytes like object of r, g, b triples
+        :param gains: fused channel gains of the modifiers
+        """
+        size = len(self.buffer)
+        self.buffer[:min(size, len(frame))] = memoryview(frame)[:size]
+
+        tables = self.tables(gains)
+        if tables is None and self.order == 'rgb':
+            data = self.buffer.translate(self.gamma_table)
+        else:
+            data = bytearray(size)
+            for i, component in enumerate(self.order):
+                source = 'rgb'.index(component)
+                data[i::3] = self.buffer[source::3].translate(self.gamma_table if tables is None else tables[source])
+
+        if self._output is None:
+            return
+        try:
+            self._output.write(data)
+            self.frames += 1
+        except OSError as e:
+            self.errors += 1
+            log.warning("Writing to %s failed: %s", self.device, e)
+
+    def tables(self, gains):
+        """
+        Pixel stripes follow the channel gains of the modifiers only, that is brightness and color temperature.
+        Gains, limit and gamma are folded into one translation table per channel.
+        :return: tables of r, g and b or None if only gamma applies
+        """
+        gains = UNITY if gains is None else tuple(gains)
+        if gains == UNITY and self.limit >= 1.0:
+            return None
+
+        key = gains + (self.limit, self.gamma)
+        if key != self._tables_key:
+            cap = min(self.limit, 1.0) * 255
+            self._tables = tuple(bytes(self.gamma_table[int(min(val * gain, cap) + 0.5)] for val in range(256))
+                                 for gain in gains)
+            self._tables_key = key
+        return self._tables
+
+    def __repr__(self):
+        return "<PixelStripe id={}>".format(self.id)
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'pixels': self.pixels,
+            'output': self.output,
+            'device': self.device,
+            'order': self.order
+        }
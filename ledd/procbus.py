@@ -0,0 +1,280 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import multiprocessing
+import signal
+import sys
+import threading
+from importlib.util import find_spec
+from multiprocessing.connection import wait
+
+from .i2cbus import I2CBus, release
+
+log = logging.getLogger(__name__)
+
+ADDRESSES = 128
+""" 7 bit I2C addresses """
+REGISTERS = 256
+""" registers mirrored per address """
+
+# spawned, a forked child would inherit the locks held by the threads of the daemon
+_context = multiprocessing.get_context('spawn')
+
+
+class ProcessBus(object):
+    """
+    Drop-in replacement of I2CBus that drives the bus from a worker process of its own, so buses are written
+    in parallel on several cores instead of sharing the GIL of the daemon.
+
+    Block writes go into a frame buffer in shared memory: the register values plus a 32 bit generation per register
+    that is bumped with every write, it can't wrap around between two snapshots of the worker. A sequence counter
+    around each write, odd while it is in progress, lets the worker take consistent snapshots without locks (seqlock).
+    The worker writes every register whose generation changed since its last snapshot, merged into block transfers.
+    Wake-ups go through a pipe and coalesce.
+    All other operations are sent to the worker and executed after the frame buffer has been written.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.users = 0
+        self.queued = 0
+        self._values = _context.RawArray('B', ADDRESSES * REGISTERS)
+        self._generations = _context.RawArray('I', ADDRESSES * REGISTERS)
+        self._sequence = _context.RawValue('L', 0)
+        self._active = _context.RawArray('B', ADDRESSES)
+        self._error_handlers = {}
+        self._lock = threading.Lock()
+        self._request_lock = threading.Lock()
+
+        self._requests, requests = _context.Pipe()
+        doorbell, self._doorbell = _context.Pipe(duplex=False)
+        errors, worker_errors = _context.Pipe(duplex=False)
+        self._process = _context.Process(target=_worker, name="i2c-{}".format(device),
+                                         args=(device, self._values, self._generations, self._sequence,
+                                               self._active, requests, doorbell, worker_errors))
+        self._process.daemon = True
+        self._process.start()
+        # the worker owns these ends now
+        requests.close()
+        doorbell.close()
+        worker_errors.close()
+
+        self._errors = errors
+        self._watcher = threading.Thread(target=self._watch, name="i2c-{}-errors".format(device), daemon=True)
+        self._watcher.start()
+
+    def __repr__(self):
+        return "<ProcessBus device={} users={} pid={}>".format(self.device, self.users, self._process.pid)
+
+    def set_error_handler(self, address, handler):
+        """
+        Registers a callable that gets the OSError of a failed frame buffer write to the given address.
+        """
+        self._error_handlers[address] = handler
+
+    def remove_error_handler(self, address, handler):
+        """
+        Unregisters the error handler of the given address, unless another one was registered meanwhile.
+        """
+        if self._error_handlers.get(address) == handler:
+            del self._error_handlers[address]
+
+    def write_i2c_block_data(self, address, register, data):
+        offset = address * REGISTERS + register
+        with self._lock:
+            self._active[address] = 1
+            self._sequence.value += 1
+            for i, value in enumerate(data):
+                self._values[offset + i] = value
+                self._generations[offset + i] = (self._generations[offset + i] + 1) & 0xFFFFFFFF
+            self._sequence.value += 1
+            self.queued += len(data)
+            self._doorbell.send_bytes(b"")
+
+    def write_byte_data(self, address, register, value):
+        self._request('write_byte_data', address, register, value)
+
+    def write_word_data(self, address, register, value):
+        self._request('write_word_data', address, register, value)
+
+    def read_byte_data(self, address, register):
+        return self._request('read_byte_data', address, register)
+
+    def read_word_data(self, address, register):
+        return self._request('read_word_data', address, register)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._request('read_i2c_block_data', address, register, length)
+
+    def flush(self):
+        """
+        Returns once the worker has written the frame buffer.
+        """
+        self._request('flush')
+
+    def close(self):
+        """
+        Releases the bus. The last user writes out the frame buffer and stops the worker.
+        """
+        if not release(self):
+            return
+
+        try:
+            self._request('close')
+        except (EOFError, OSError) as e:
+            log.warning("Worker of i2c-%s is gone: %s", self.device, e)
+        self._process.join()
+        self._requests.close()
+        self._doorbell.close()
+
+    @property
+    def by_address(self):
+        return self._request('by_address')
+
+    @property
+    def stats(self):
+        return dict(self._request('stats'), device=self.device, queued=self.queued, pid=self._process.pid)
+
+    def _request(self, operation, *args):
+        with self._request_lock:
+            self._requests.send((operation, args))
+            error, result = self._requests.recv()
+        if error is not None:
+            raise error
+        return result
+
+    def _watch(self):
+        while True:
+            try:
+                address, error = self._errors.recv()
+            except (EOFError, OSError):
+                return
+
+            handler = self._error_handlers.get(address)
+            if handler is not None:
+                handler(error)
+            else:
+                log.warning("Writing to %s on i2c-%s failed: %s", hex(address), self.device, error)
+
+
+def _worker(device, values, generations, sequence, active, requests, doorbell, errors):
+    """
+    Entry point of the worker process of one bus.
+    """
+    # service managers signal the whole process group, the daemon stops its workers itself after the final writes
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # the main module is imported again in the worker and may have installed the simulator already
+    if "smbus" not in sys.modules and find_spec("smbus") is None:
+        from . import simbus
+        simbus.install()
+    import smbus
+
+    bus = smbus.SMBus(device)
+    values = memoryview(values).cast('B')
+    generations = memoryview(generations).cast('B').cast('I')
+    written = {}
+    """ generations of the last written snapshot per address, registers still at 0 were never written """
+    unwritten = [0] * REGISTERS
+    counters = {}
+
+    def count(address, nbytes, failed=False):
+        entry = counters.get(address)
+        if entry is None:
+            entry = counters[address] = {'transactions': 0, 'bytes': 0, 'errors': 0}
+        if failed:
+            entry['errors'] += 1
+        else:
+            entry['transactions'] += 1
+            entry['bytes'] += nbytes
+
+    def snapshot():
+        addresses = [address for address in range(ADDRESSES) if active[address]]
+        while True:
+            before = sequence.value
+            if before & 1:
+                continue
+            frame = [(address, bytes(values[address * REGISTERS:(address + 1) * REGISTERS]),
+                      generations[address * REGISTERS:(address + 1) * REGISTERS].tolist()) for address in addresses]
+            if sequence.value == before:
+                return frame
+
+    def write_frame():
+        pending = {}
+        for address, frame_values, frame_generations in snapshot():
+            last = written.get(address, unwritten)
+            if last == frame_generations:
+                continue
+            for register in range(REGISTERS):
+                if last[register] != frame_generations[register]:
+                    pending[(address, register)] = frame_values[register]
+            written[address] = frame_generations
+
+        failed = set()
+        for address, register, data in I2CBus._blocks(pending):
+            if address in failed:
+                continue
+            try:
+                bus.write_i2c_block_data(address, register, data)
+                count(address, len(data))
+            except OSError as e:
+                count(address, 0, True)
+                failed.add(address)
+                errors.send((address, e))
+
+    while True:
+        for ready in wait([requests, doorbell]):
+            if ready is doorbell:
+                try:
+                    while doorbell.poll():
+                        doorbell.recv_bytes()
+                except EOFError:
+                    # the daemon is gone
+                    return
+                write_frame()
+                continue
+
+            try:
+                operation, args = requests.recv()
+            except EOFError:
+                # the daemon is gone
+                return
+
+            write_frame()
+            error = result = None
+            if operation == 'close':
+                bus.close()
+                requests.send((None, None))
+                return
+            elif operation == 'stats':
+                result = {
+                    'transactions': sum(c['transactions'] for c in counters.values()),
+                    'bytes': sum(c['bytes'] for c in counters.values()),
+                    'errors': sum(c['errors'] for c in counters.values())
+                }
+            elif operation == 'by_address':
+                result = counters
+            elif operation != 'flush':
+                try:
+                    result = getattr(bus, operation)(*args)
+                    count(args[0], 1 if operation.endswith('byte_data') else
+                          2 if operation.endswith('word_data') else args[-1])
+                except OSError as e:
+                    count(args[0], 0, True)
+                    error = e
+            requests.send((error, result))
@@ -0,0 +1,233 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+MODES = (CPROFILE, SAMPLING)
+
+session = None
+""" the running profiling session, checked by the hot paths, :type : ProfilingSession """
+
+
+class ProfilingSession(object):
+    """
+    Base of a time boxed profiling session. Besides the profile itself every session times the rendering of each
+    effect class, see EffectStack.render.
+    """
+    mode = None
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.started = None
+        self.stopped = None
+        self.effects = {}
+        """ calls and seconds per effect class name, :type : dict[str, list] """
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def stop(self):
+        self.stopped = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self.stopped or time.monotonic()) - self.started
+
+    def attribute(self, effect_type, seconds):
+        """
+        Adds the render time of one frame to an effect class.
+        """
+        entry = self.effects.get(effect_type.__name__)
+        if entry is None:
+            entry = self.effects[effect_type.__name__] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def top(self, n, sort):
+        """
+        :return: the n most expensive functions
+        :rtype: list[dict]
+        """
+        raise NotImplementedError
+
+    def dump(self, path):
+        raise NotImplementedError
+
+    def summary(self, n=20, sort='self'):
+        elapsed = self.elapsed
+        return {
+            'mode': self.mode,
+            'seconds': elapsed,
+            'running': self.stopped is None,
+            'top': self.top(n, sort),
+            'effects': sorted(({'effect': name, 'frames': calls, 'seconds': seconds,
+                                'share': seconds / elapsed if elapsed else 0.0}
+                               for name, (calls, seconds) in self.effects.items()),
+                              key=lambda e: e['seconds'], reverse=True)
+        }
+
+
+class CProfileSession(ProfilingSession):
+    """
+    Deterministic profile of the event loop thread with cProfile. Precise, but slows every call down.
+    """
+    mode = CPROFILE
+
+    def __init__(self, duration):
+        super().__init__(duration)
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        super().start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        super().stop()
+
+    def top(self, n, sort):
+        key = 3 if sort == 'total' else 2
+        stats = pstats.Stats(self.profile).stats
+        entries = sorted(stats.items(), key=lambda item: item[1][key], reverse=True)[:n]
+        return [{'function': _describe(*function), 'calls': calls, 'self': tt, 'total': ct}
+                for function, (cc, calls, tt, ct, callers) in entries]
+
+    def dump(self, path):
+        """
+        Writes pstats data, readable with python -m pstats.
+        """
+        self.profile.dump_stats(path)
+
+
+class SamplingSession(ProfilingSession):
+    """
+    Statistical profile of all threads: the event loop, render and flush workers and the I2C bus threads.
+    A sampler thread looks at the stacks of all threads every interval seconds, the profiled code is not slowed down.
+    """
+    mode = SAMPLING
+
+    def __init__(self, duration, interval=0.005):
+        super().__init__(duration)
+        self.interval = interval
+        self.samples = 0
+        """ stacks looked at, one per thread and tick """
+        self.ticks = 0
+        self.leaves = Counter()
+        """ samples in which the function was running """
+        self.functions = Counter()
+        """ samples in which the function was on the stack """
+        self.stacks = Counter()
+        """ samples per complete stack, for flame graphs """
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        super().start()
+        self._thread = threading.Thread(target=self._run, name="profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        super().stop()
+
+    def _run(self):
+        own = threading.get_ident()
+
+        while not self._stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            self.ticks += 1
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+
+                self.samples += 1
+                self.leaves[stack[0]] += 1
+                for function in set(stack):
+                    self.functions[function] += 1
+                self.stacks[(names.get(ident, str(ident)),) + tuple(reversed(stack))] += 1
+
+    def top(self, n, sort):
+        counter = self.functions if sort == 'total' else self.leaves
+        # every tick samples each thread once, a sample stands for the time between two ticks
+        seconds = self.elapsed / max(self.ticks, 1)
+        return [{'function': _describe(*function), 'samples': self.leaves[function],
+                 'self': self.leaves[function] * seconds, 'total': self.functions[function] * seconds}
+                for function, count in counter.most_common(n)]
+
+    def dump(self, path):
+        """
+        Writes folded stacks, one "thread;outer;...;inner count" line per stack, as used by flame graph tools.
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{};{} {}\n".format(stack[0], ";".join(_describe(*function) for function in stack[1:]), count))
+
+
+def _describe(filename, line, name):
+    return "{}:{}({})".format(os.path.basename(filename), line, name)
+
+
+def start(mode, duration, interval=0.005):
+    """
+    Starts a session, which becomes the module session.
+    :raises ValueError: for unknown modes
+    :rtype: ProfilingSession
+    """
+    global session
+    if mode == CPROFILE:
+        new = CProfileSession(duration)
+    elif mode == SAMPLING:
+        new = SamplingSession(duration, interval)
+    else:
+        raise ValueError("Unknown profiling mode: {}".format(mode))
+
+    new.start()
+    session = new
+    log.info("Started %s profiling for %ss", mode, duration)
+    return new
+
+
+def stop():
+    """
+    Stops the running session.
+    :return: the stopped session or None if none is running
+    :rtype: ProfilingSession
+    """
+    global session
+    stopped, session = session, None
+    if stopped is not None:
+        stopped.stop()
+        log.info("Stopped %s profiling after %.1fs", stopped.mode, stopped.elapsed)
+    return stopped
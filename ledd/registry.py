@@ -0,0 +1,109 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+
+class Registry(object):
+    """
+    Runtime index of all controllers and stripes known to the daemon.
+    RPC handlers resolve ids through it instead of scanning lists or querying the database.
+    """
+
+    def __init__(self):
+        self.controllers = OrderedDict()
+        """ :type : dict[int, ledd.controller.Controller] """
+        self.stripes = OrderedDict()
+        """ :type : dict[int, ledd.stripe.Stripe] """
+        self.pixel_stripes = OrderedDict()
+        """ :type : dict[int, ledd.pixelstripe.PixelStripe] """
+        self._by_controller = {}
+        self._by_channel = {}
+
+    def add_controller(self, c):
+        """
+        :type c: ledd.controller.Controller
+        """
+        self.controllers[c.id] = c
+        self._by_controller.setdefault(c.id, [])
+
+    def add_stripe(self, s):
+        """
+        The stripe has to be attached to its controller already.
+        :type s: ledd.stripe.Stripe
+        """
+        self.stripes[s.id] = s
+        self._by_controller.setdefault(s.controller.id, []).append(s)
+        for channel in s.channels:
+            self._by_channel[(s.controller.id, channel)] = s
+        s.controller.invalidate_status()
+
+    def add_pixel_stripe(self, s):
+        """
+        :type s: ledd.pixelstripe.PixelStripe
+        """
+        self.pixel_stripes[s.id] = s
+
+    def next_controller_id(self):
+        """
+        Ids are handed out here, so adding a controller does not have to wait for the database to assign one.
+        :rtype: int
+        """
+        return max(self.controllers, default=0) + 1
+
+    def next_stripe_id(self):
+        """
+        :rtype: int
+        """
+        return max(max(self.stripes, default=0), max(self.pixel_stripes, default=0)) + 1
+
+    def get_controller(self, cid):
+        """
+        :rtype: ledd.controller.Controller
+        """
+        return self.controllers.get(cid)
+
+    def get_stripe(self, sid):
+        """
+        :rtype: ledd.stripe.Stripe
+        """
+        return self.stripes.get(sid)
+
+    def find_stripes(self, sids):
+        """
+        :return: the known stripes out of sids, unknown ids are skipped
+        :rtype: list[ledd.stripe.Stripe]
+        """
+        return [self.stripes[sid] for sid in sids if sid in self.stripes]
+
+    def find_pixel_stripes(self, sids):
+        """
+        :rtype: list[ledd.pixelstripe.PixelStripe]
+        """
+        return [self.pixel_stripes[sid] for sid in sids if sid in self.pixel_stripes]
+
+    def stripes_of(self, cid):
+        """
+        :rtype: list[ledd.stripe.Stripe]
+        """
+        return self._by_controller.get(cid, [])
+
+    def stripe_on_channel(self, cid, channel):
+        """
+        :return: the stripe using the channel of the controller, if any
+        :rtype: ledd.stripe.Stripe
+        """
+        return self._by_channel.get((cid, channel))
@@ -0,0 +1,325 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ledd.color import HSV, PIXELS, hsv_to_rgb
+from ledd.modifiers import Modifiers, fuse, fuse_gains, transform
+from ledd.stats import metrics
+from ledd.transition import Transition
+
+log = logging.getLogger(__name__)
+
+
+class StagedColor(object):
+    """
+    Frame entry for a color set directly on a stripe, outside of any effect stack.
+    """
+    __slots__ = ('stripes',)
+
+    def __init__(self, stripe):
+        self.stripes = (stripe,)
+
+    def apply(self, color, matrix=None):
+        self.stripes[0].set_color(color, transform(matrix, color) if matrix is not None else None)
+
+
+class ControllerLevel(object):
+    """
+    Frame entry setting all channels of a controller to raw levels, like Controller.set_all_channel.
+    """
+    __slots__ = ('controller', 'stripes')
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.stripes = ()
+
+    def apply(self, levels, matrix=None):
+        # raw levels are not modified
+        for channel, level in enumerate(levels):
+            self.controller.stage(channel, int(level * 4095))
+
+
+class FrameScheduler(object):
+    """
+    Global render clock of the daemon.
+    Every tick renders all active effect stacks in one pass, adds the colors staged for single stripes since the
+    last tick and the current values of running transitions, and commits all controllers together.
+    Ticks are scheduled on monotonic deadlines, so render time does not add up to drift. Frames that can't be
+    rendered in time are counted as overruns and skipped.
+
+    With render workers enabled, effects are rendered and flushed to the hardware in two worker threads instead of
+    on the event loop. The stages form a double buffer: while one frame is written to the bus the next one is
+    rendered, and a rendered frame waiting for the bus is replaced by a newer one.
+    """
+
+    def __init__(self, loop, controllers, fps=10.0, workers=False):
+        """
+        :type loop: asyncio.BaseEventLoop
+        :param controllers: all known controllers, shared with the daemon
+        :param fps: frames per second
+        :param workers: render and flush in worker threads
+        """
+        if fps <= 0:
+            raise ValueError("fps must be positive: {}".format(fps))
+
+        self.loop = loop
+        self.controllers = controllers
+        self.stacks = OrderedDict()
+        self.staged = {}
+        """ colors for single stripes waiting for the next tick, by stripe id """
+        self.transitions = {}
+        """ :type : dict[object, ledd.transition.Transition] """
+        self.sources = []
+        """ callables returning (stripe, rgb) pairs to stage with every tick, the clock runs while there are any """
+        self.frame_listeners = []
+        """ callables getting every flushed frame, always called on the loop """
+        self.modifiers = Modifiers()
+        """ global modifiers, applied to everything but raw controller levels """
+        self.period = 1.0 / fps
+        self.frames = 0
+        self.overruns = 0
+        self.render_time = metrics.histogram('ledd_render_seconds')
+        self.flush_time = metrics.histogram('ledd_flush_seconds')
+        self._deadline = None
+        self._handle = None
+
+        self._render_pool = None
+        self._flush_pool = None
+        self._rendering = None
+        self._flushing = None
+        self._next_frame = None
+        if workers:
+            self._render_pool = ThreadPoolExecutor(max_workers=1)
+            self._flush_pool = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def running(self):
+        return self._handle is not None
+
+    def add(self, stack):
+        self.stacks[stack] = None
+        self.wake()
+
+    def remove(self, stack):
+        self.stacks.pop(stack, None)
+
+    def stage(self, stripe, color):
+        """
+        Sets the rgb color of a stripe with the next frame. Colors staged again before that replace each other.
+        Must be called on the loop.
+        """
+        self.staged[stripe.id] = (stripe, color)
+        self.wake()
+
+    def fade(self, key, target, start, end, duration, easing='linear'):
+        """
+        Starts a transition, replacing a running one with the same key. Must be called on the loop.
+        :param key: identifies what is faded, e.g. ('stripe', sid)
+        :param target: StagedColor or ControllerLevel receiving the values
+        :raises KeyError: for unknown easings
+        """
+        self.transitions[key] = Transition(target, start, end, self.loop.time(), duration, easing)
+        self.wake()
+
+    def current(self, key, now=None):
+        """
+        :return: the current values of the transition with that key or None if there is none
+        """
+        transition = self.transitions.get(key)
+        if transition is None:
+            return None
+        return transition.at(self.loop.time() if now is None else now)
+
+    def matrix(self, target=None):
+        """
+        :return: the global modifiers fused with those of the frame entry, None if colors stay unchanged
+        """
+        return fuse(self.modifiers, getattr(target, 'modifiers', None))
+
+    def gains(self, target):
+        """
+        :return: the channel gains of the global modifiers and those of the frame entry, None if they are 1
+        """
+        return fuse_gains(self.modifiers, target.modifiers)
+
+    def cancel(self, key):
+        self.transitions.pop(key, None)
+
+    def wake(self):
+        """
+        Starts the clock if it is idle. The clock stops by itself once there is nothing to render.
+        """
+        if self._handle is None:
+            self._deadline = self.loop.time()
+            self._handle = self.loop.call_soon(self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        for pool in (self._render_pool, self._flush_pool):
+            if pool is not None:
+                pool.shutdown()
+
+    def _tick(self):
+        self._handle = None
+
+        if not self.stacks and not self.staged and not self.transitions and not self.sources:
+            log.debug("Nothing to render, stopping render clock")
+            return
+
+        if self._render_pool is None:
+            # a broken effect or controller must not stop the clock, like in the worker path
+            try:
+                frame = self.render(list(self.stacks)) + self._take_staged() + self._step_transitions()
+                self.flush(frame)
+                self._notify(frame)
+            except Exception:
+                log.exception("Rendering frame failed")
+            self.frames += 1
+        elif self._rendering is None:
+            self._rendering = self._render_pool.submit(self.render, list(self.stacks))
+            self._rendering.add_done_callback(self._threadsafe(self._rendered))
+            self.frames += 1
+        else:
+            # the previous frame is still rendering, this one is skipped
+            self.overruns += 1
+
+        self._deadline += self.period
+        now = self.loop.time()
+        if now >= self._deadline:
+            missed = int((now - self._deadline) / self.period) + 1
+            self.overruns += missed
+            self._deadline += missed * self.period
+            log.debug("Render clock overrun, skipping %s frame(s)", missed)
+
+        self._handle = self.loop.call_at(self._deadline, self._tick)
+
+    def render(self, stacks):
+        """
+        Renders the next frame of the given stacks, colors of stacks rendering in HSV are converted to RGB.
+        :return: list of (stack, rgb) pairs
+        """
+        started = time.perf_counter()
+        colors = []
+        for stack in stacks:
+            color = stack.render()
+            # asked after rendering, a stack switches to rgb once its frame table is baked
+            colors.append(hsv_to_rgb(*color) if stack.color_space == HSV else color)
+
+        self.render_time.observe(time.perf_counter() - started)
+        return list(zip(stacks, colors))
+
+    def flush(self, frame):
+        """
+        Applies a rendered frame and writes the result to the controllers.
+        """
+        # snapshot, controllers may be added by the loop while a worker flushes
+        controllers = list(self.controllers)
+        started = time.perf_counter()
+
+        for c in controllers:
+            c.begin()
+
+        try:
+            for stack, color in frame:
+                # pixel stripes can only scale their channels, they get the gains instead of the matrix
+                if stack.color_space == PIXELS:
+                    stack.apply(color, self.gains(stack))
+                else:
+                    stack.apply(color, self.matrix(stack))
+        finally:
+            # every controller gets its commit, a failing one must not leave the others in an open frame
+            for c in controllers:
+                try:
+                    c.commit()
+                except OSError as e:
+                    if e.errno == errno.ECOMM:
+                        log.warning("Communication error on I2C Bus")
+                    else:
+                        log.error("Writing to controller %s failed: %s", c.id, e)
+                except Exception:
+                    log.exception("Committing controller %s failed", c.id)
+            self.flush_time.observe(time.perf_counter() - started)
+
+    def _take_staged(self):
+        staged, self.staged = self.staged, {}
+        for source in self.sources:
+            for stripe, color in source():
+                staged[stripe.id] = (stripe, color)
+        return [(StagedColor(stripe), color) for stripe, color in staged.values()]
+
+    def _step_transitions(self):
+        now = self.loop.time()
+        entries = []
+
+        for key, t in list(self.transitions.items()):
+            try:
+                entries.append((t.target, t.at(now)))
+            except Exception:
+                # a broken transition must not stop the clock for everything else
+                log.exception("Transition %s failed, dropping it", key)
+                del self.transitions[key]
+                continue
+            if t.done(now):
+                del self.transitions[key]
+
+        return entries
+
+    def _notify(self, frame):
+        for listener in self.frame_listeners:
+            listener(frame)
+
+    def _threadsafe(self, callback):
+        return lambda future: self.loop.call_soon_threadsafe(callback, future)
+
+    def _rendered(self, future):
+        self._rendering = None
+
+        if future.exception() is not None:
+            log.error("Rendering frame failed", exc_info=future.exception())
+            return
+
+        if self._flushing is None:
+            self._submit_flush(future.result())
+        else:
+            if self._next_frame is not None:
+                self.overruns += 1
+            self._next_frame = future.result()
+
+    def _flushed(self, frame, future):
+        self._flushing = None
+
+        if future.exception() is not None:
+            log.error("Flushing frame failed", exc_info=future.exception())
+        else:
+            self._notify(frame)
+
+        if self._next_frame is not None:
+            frame, self._next_frame = self._next_frame, None
+            self._submit_flush(frame)
+
+    def _submit_flush(self, frame):
+        frame = frame + self._take_staged() + self._step_transitions()
+        self._flushing = self._flush_pool.submit(self.flush, frame)
+        self._flushing.add_done_callback(self._threadsafe(partial(self._flushed, frame)))
@@ -0,0 +1,152 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import types
+
+from .controller import PCA9685_MODE1, PCA9685_MODE2, PCA9685_PRESCALE, LED0_ON_L, ALLLED_ON_L, PCA9685_CHANNELS
+
+MODE1_SLEEP = 0x10
+MODE1_AI = 0x20
+LED_FULL = 0x10
+
+buses = {}
+""" simulated buses by device number, :type : dict[int, SMBus] """
+
+
+class PCA9685(object):
+    """
+    Register file of one simulated PCA9685, initialized with the power-on defaults of the datasheet.
+    """
+
+    def __init__(self):
+        self.registers = bytearray(256)
+        self.registers[PCA9685_MODE1] = MODE1_SLEEP | 0x01
+        self.registers[PCA9685_MODE2] = 0x04
+        self.registers[PCA9685_PRESCALE] = 0x1E
+        for channel in range(PCA9685_CHANNELS):
+            # all outputs start fully off
+            self.registers[LED0_ON_L + 4 * channel + 3] = LED_FULL
+
+    def read(self, register, length):
+        step = 1 if self.registers[PCA9685_MODE1] & MODE1_AI else 0
+        return [self.registers[(register + i * step) & 0xFF] for i in range(length)]
+
+    def write(self, register, data):
+        step = 1 if self.registers[PCA9685_MODE1] & MODE1_AI else 0
+        for i, value in enumerate(data):
+            self._write_register((register + i * step) & 0xFF, value & 0xFF)
+
+    def _write_register(self, register, value):
+        if register == PCA9685_PRESCALE and not self.registers[PCA9685_MODE1] & MODE1_SLEEP:
+            # the prescaler is only writable while the oscillator sleeps
+            return
+
+        self.registers[register] = value
+        if ALLLED_ON_L <= register < ALLLED_ON_L + 4:
+            for channel in range(PCA9685_CHANNELS):
+                self.registers[LED0_ON_L + 4 * channel + register - ALLLED_ON_L] = value
+
+    def level(self, channel):
+        """
+        :return: the 12 bit OFF value of a channel
+        :rtype: int
+        """
+        off = LED0_ON_L + 4 * channel + 2
+        return self.registers[off] | (self.registers[off + 1] & 0x0F) << 8
+
+
+class SMBus(object):
+    """
+    Drop-in replacement of smbus.SMBus that simulates PCA9685 controllers at any address.
+    Every transaction takes latency seconds plus byte_time per transferred byte, the time it would occupy the bus.
+    """
+    latency = 0.0
+    byte_time = 0.0
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.devices = {}
+        """ :type : dict[int, PCA9685] """
+        self.transactions = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        buses[bus] = self
+
+    def device(self, address):
+        """
+        :rtype: PCA9685
+        """
+        device = self.devices.get(address)
+        if device is None:
+            device = self.devices[address] = PCA9685()
+        return device
+
+    def _transfer(self, written, read=0):
+        self.transactions += 1
+        self.bytes_written += written
+        self.bytes_read += read
+        delay = self.latency + (written + read) * self.byte_time
+        if delay:
+            time.sleep(delay)
+
+    def write_byte_data(self, address, register, value):
+        self._transfer(2)
+        self.device(address).write(register, [value])
+
+    def read_byte_data(self, address, register):
+        self._transfer(1, 1)
+        return self.device(address).read(register, 1)[0]
+
+    def write_word_data(self, address, register, value):
+        self._transfer(3)
+        self.device(address).write(register, [value & 0xFF, value >> 8 & 0xFF])
+
+    def read_word_data(self, address, register):
+        self._transfer(1, 2)
+        low, high = self.device(address).read(register, 2)
+        return low | high << 8
+
+    def write_i2c_block_data(self, address, register, data):
+        self._transfer(1 + len(data))
+        self.device(address).write(register, data)
+
+    def read_i2c_block_data(self, address, register, length=32):
+        self._transfer(1, length)
+        return self.device(address).read(register, length)
+
+    def close(self):
+        pass
+
+    @property
+    def stats(self):
+        return {
+            'transactions': self.transactions,
+            'bytes_written': self.bytes_written,
+            'bytes_read': self.bytes_read
+        }
+
+
+def install(latency=0.0, byte_time=0.0):
+    """
+    Registers the simulator as smbus module, for machines without I2C hardware.
+    """
+    SMBus.latency = latency
+    SMBus.byte_time = byte_time
+    module = types.ModuleType("smbus")
+    module.SMBus = SMBus
+    sys.modules['smbus'] = module
@@ -14,11 +14,29 @@ CREATE TABLE "meta" (
   `option` TEXT,
   `value`  TEXT
 );
-INSERT INTO `meta` VALUES ('db_version', '2');
+INSERT INTO `meta` VALUES ('db_version', '4');
 CREATE TABLE "controller" (
   `id`         INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
   `address`    TEXT,
   `i2c_device` INTEGER,
   `channels`   INTEGER,
   `pwm_freq`   INTEGER
+);
+CREATE TABLE `stripe_state` (
+  `stripe_id`      INTEGER PRIMARY KEY,
+  `color_r`        REAL,
+  `color_g`        REAL,
+  `color_b`        REAL,
+  `effect`         TEXT,
+  `effect_options` TEXT
+);
+CREATE TABLE `pixel_stripe` (
+  `id`     INTEGER PRIMARY KEY,
+  `name`   TEXT,
+  `pixels` INTEGER,
+  `output` TEXT,
+  `device` TEXT,
+  `speed`  INTEGER,
+  `order`  TEXT DEFAULT 'rgb',
+  `gamma`  REAL DEFAULT 2.8
 );
\ No newline at end of file
@@ -0,0 +1,10 @@
+CREATE TABLE `stripe_state` (
+  `stripe_id`      INTEGER PRIMARY KEY,
+  `color_r`        REAL,
+  `color_g`        REAL,
+  `color_b`        REAL,
+  `effect`         TEXT,
+  `effect_options` TEXT
+);
+
+REPLACE INTO meta (`option`, `value`) VALUES (`db_version`, `3`);
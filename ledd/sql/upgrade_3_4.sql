@@ -0,0 +1,12 @@
+CREATE TABLE `pixel_stripe` (
+  `id`     INTEGER PRIMARY KEY,
+  `name`   TEXT,
+  `pixels` INTEGER,
+  `output` TEXT,
+  `device` TEXT,
+  `speed`  INTEGER,
+  `order`  TEXT DEFAULT 'rgb',
+  `gamma`  REAL DEFAULT 2.8
+);
+
+REPLACE INTO meta (`option`, `value`) VALUES (`db_version`, `4`);
@@ -0,0 +1,191 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+""" upper bounds in seconds, an implicit +Inf bucket follows """
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram. Observing costs one bisect and two additions, so it is cheap enough for every tick.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: (upper bound, observations <= bound) pairs, the last bound is +Inf
+        :rtype: list[(float, int)]
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [[bound if bound != float('inf') else "+Inf", count] for bound, count in self.cumulative()]
+        }
+
+
+class Metrics(object):
+    """
+    Histograms filled by the hot paths of the daemon plus collectors, callables that are only asked for their
+    counters when the metrics are read.
+    """
+
+    def __init__(self):
+        self.histograms = OrderedDict()
+        """ :type : dict[(str, tuple), Histogram] """
+        self.collectors = []
+        """ callables returning iterables of (name, labels, value) counter samples """
+
+    def histogram(self, name, **labels):
+        """
+        :return: the histogram of that name and labels, created on first use
+        :rtype: Histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def timed(self, name, fn, **labels):
+        """
+        Wraps fn, observing the duration of every call in the histogram of that name and labels.
+        """
+        histogram = self.histogram(name, **labels)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    def samples(self):
+        """
+        :rtype: list[(str, dict, int)]
+        """
+        result = []
+        for collector in self.collectors:
+            result.extend(collector())
+        return result
+
+    def to_json(self):
+        histograms = OrderedDict()
+        for (name, labels), histogram in self.histograms.items():
+            if not histogram.count:
+                continue
+            histograms.setdefault(name, []).append(dict(histogram.to_json(), labels=dict(labels)))
+
+        counters = OrderedDict()
+        for name, labels, value in self.samples():
+            counters.setdefault(name, []).append({'labels': labels, 'value': value})
+
+        return {
+            'histograms': histograms,
+            'counters': counters
+        }
+
+    def prometheus(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+        typed = set()
+
+        for (name, labels), histogram in self.histograms.items():
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} histogram".format(name))
+            for bound, count in histogram.cumulative():
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append("{}_bucket{} {}".format(name, _labels(labels + (('le', le),)), count))
+            lines.append("{}_sum{} {!r}".format(name, _labels(labels), histogram.sum))
+            lines.append("{}_count{} {}".format(name, _labels(labels), histogram.count))
+
+        for name, labels, value in self.samples():
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} counter".format(name))
+            lines.append("{}{} {}".format(name, _labels(sorted(labels.items())), value))
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+class MetricsProtocol(asyncio.Protocol):
+    """
+    Minimal HTTP endpoint answering every request with the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.buffer = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if b"\r\n\r\n" not in self.buffer and b"\n\n" not in self.buffer:
+            if len(self.buffer) > 8192:
+                self.transport.close()
+            return
+
+        body = metrics.prometheus().encode()
+        self.transport.write(b"HTTP/1.0 200 OK\r\n"
+                             b"Content-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        self.transport.close()
+
+
+metrics = Metrics()
+""" metrics of the daemon """
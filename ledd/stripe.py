@@ -14,12 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from spectra import Color
 from sqlalchemy import Integer, ForeignKey, String, Float, Boolean
 from sqlalchemy import Column
-from sqlalchemy.orm import reconstructor
+from sqlalchemy.orm import reconstructor, validates
 
 from . import Base
+from .color import clamp
+from .gamma import gamma_table, DEFAULT_GAMMA, MAXVAL
+
+GAMMA_COLUMNS = ('channel_r_gamma', 'channel_g_gamma', 'channel_b_gamma')
 
 
 class Stripe(Base):
@@ -33,9 +36,9 @@ class Stripe(Base):
     channel_r = Column(Integer)
     channel_g = Column(Integer)
     channel_b = Column(Integer)
-    channel_r_gamma = Column(Float, default=2.8)
-    channel_g_gamma = Column(Float, default=2.8)
-    channel_b_gamma = Column(Float, default=2.8)
+    channel_r_gamma = Column(Float, default=DEFAULT_GAMMA)
+    channel_g_gamma = Column(Float, default=DEFAULT_GAMMA)
+    channel_b_gamma = Column(Float, default=DEFAULT_GAMMA)
     rgb = Column(Boolean)
 
     @property
@@ -49,32 +52,54 @@ class Stripe(Base):
         self.channel_r, self.channel_g, self.channel_b = t
 
     def __init__(self, *args, **kwargs):
+        for column in GAMMA_COLUMNS:
+            kwargs.setdefault(column, DEFAULT_GAMMA)
         super().__init__(*args, **kwargs)
+        self.controller = None
+        """ set together with controller_id, a plain attribute so it can be used outside of the db thread """
         self._color = None
-        self.gamma_correct = (self.channel_r_gamma, self.channel_g_gamma, self.channel_b_gamma)
+        self.limit = 1.0
+        self.gamma_tables = tuple(gamma_table(getattr(self, column)) for column in GAMMA_COLUMNS)
         self.read_color()
 
     @reconstructor
     def init_on_load(self):
+        self.controller = None
         self._color = None
-        self.gamma_correct = (self.channel_r_gamma, self.channel_g_gamma, self.channel_b_gamma)
-        self.read_color()
+        self.limit = 1.0
+        """ highest level of every channel, applied after the modifiers """
+        self.gamma_tables = tuple(gamma_table(getattr(self, column)) for column in GAMMA_COLUMNS)
+
+    @validates(*GAMMA_COLUMNS)
+    def validate_gamma(self, key, gamma):
+        # tables do not exist yet while the constructor assigns the columns
+        if hasattr(self, 'gamma_tables'):
+            tables = list(self.gamma_tables)
+            tables[GAMMA_COLUMNS.index(key)] = gamma_table(gamma)
+            self.gamma_tables = tuple(tables)
+        return gamma
 
     def read_color(self):
         if self.controller:
-            rc = tuple([float(self.controller.get_channel(channel)) for channel in self.channels])
-            c = Color("rgb", rc[0], rc[1], rc[2])
-            self._color = c.to("hsv")
+            self._color = tuple(float(self.controller.get_channel(channel)) for channel in self.channels)
 
     def __repr__(self):
         return "<Stripe id={}>".format(self.id)
 
-    def set_color(self, c):
+    def set_color(self, c, output=None):
+        """
+        :param c: rgb tuple
+        :param output: rgb tuple written instead of c, usually c transformed by the modifiers
+        """
         self._color = c
-        for channel, gamma_correct, value in zip(self.channels, self.gamma_correct, c.clamped_rgb):
-            self.controller.set_channel(channel, value, gamma_correct)
+        limit = self.limit
+        for channel, table, value in zip(self.channels, self.gamma_tables, c if output is None else output):
+            self.controller.stage(channel, table[int(clamp(min(value, limit)) * MAXVAL)])
 
     def get_color(self):
+        """
+        :return: rgb tuple
+        """
         return self._color
 
     def to_json(self):
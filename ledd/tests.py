@@ -15,9 +15,131 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import configparser
+import errno
 import socket
 import json
+import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import Future
+
+from jsonrpc import JSONRPCResponseManager, dispatcher
+from sqlalchemy import create_engine
+
+import ledd.controller  # noqa, registers the tables stripe_state refers to
+import ledd.stripe  # noqa
+import ledd.daemon  # noqa, registers the rpc methods
+from ledd import Base, session
+from ledd.persistence import DBWorker, save_states, load_states
+from ledd import simbus, i2cbus
+from ledd.controller import Controller
+from ledd.models import Meta
+from ledd.stripe import Stripe
+from ledd.simbus import SMBus, PCA9685, MODE1_AI, MODE1_SLEEP
+from ledd.procbus import ProcessBus
+from ledd.stats import Histogram, Metrics
+from ledd import profiling
+from ledd.effectstack import EffectStack, PixelStack
+from ledd.effects.fadeeffect import FadeEffect
+from ledd.effects.rainboweffect import RainbowEffect
+from ledd.pixelstripe import PixelStripe
+from ledd.modifiers import Modifiers, fuse, transform
+from ledd.framebuffer import FrameBuffer, FrameBufferWriter, slot_offset, GENERATION
+from ledd.color import RGB
+from ledd.scheduler import FrameScheduler
+from ledd.udpframe import encode_frame, decode_frame, is_newer
+
+
+class FakeHandle(object):
+    def __init__(self, loop, when, callback, args):
+        self.loop, self.when, self.callback, self.args = loop, when, callback, args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop(object):
+    """
+    Runs callbacks in the order of their deadlines, time only moves when a callback is due or by advance.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback, *args):
+        handle = FakeHandle(self, when, callback, args)
+        self.handles.append(handle)
+        return handle
+
+    def call_soon(self, callback, *args):
+        return self.call_at(self.now, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now + delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        return self.call_soon(callback, *args)
+
+    def run_until(self, end):
+        while True:
+            pending = [h for h in self.handles if not h.cancelled and h.when <= end]
+            if not pending:
+                break
+            handle = min(pending, key=lambda h: h.when)
+            self.handles.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.callback(*handle.args)
+        self.now = max(self.now, end)
+
+
+class Target(object):
+    stripes = ()
+    color_space = RGB
+
+    def __init__(self, loop=None, render_time=0.0):
+        self.values = []
+        self.loop = loop
+        self.render_time = render_time
+
+    def render(self):
+        if self.render_time:
+            self.loop.now += self.render_time
+        return 0.0, 0.0, 0.0
+
+    def apply(self, values, matrix=None):
+        self.values.append(values)
+
+
+class FakeController(object):
+    def __init__(self, cid, error=None):
+        self.id = cid
+        self.error = error
+        self.depth = 0
+        self.commits = 0
+
+    def begin(self):
+        self.depth += 1
+
+    def commit(self):
+        self.depth -= 1
+        self.commits += 1
+        if self.error is not None:
+            raise self.error
+
+
+def simulated_controller(device, address="0x40"):
+    """
+    :return: a probed controller on a simulated bus of its own and the simulated bus
+    """
+    simbus.install()
+    controller = Controller(channels=16, i2c_device=device, address=address, _pwm_freq=1526)
+    return controller, simbus.buses[device]
 
 
 class TestDaemon:
@@ -59,3 +181,618 @@ class TestDaemon:
         rjson = json.loads(rstr)
         assert rjson['ref'] == ref
         assert rjson['version'] is not None
+
+    def recv_lines(self, count):
+        data = b""
+        while data.count(b"\n") < count:
+            data += self.s.recv(1024)
+        return [json.loads(line.decode()) for line in data.splitlines()]
+
+    def test_pipelined_requests(self):
+        requests = [{"jsonrpc": "2.0", "method": "discover", "id": i} for i in range(3)]
+
+        self.s.send("".join(json.dumps(r) + "\n" for r in requests).encode())
+
+        responses = self.recv_lines(3)
+        assert [r['id'] for r in responses] == [0, 1, 2]
+        assert all(r['result']['version'] is not None for r in responses)
+
+    def test_split_request(self):
+        request = (json.dumps({"jsonrpc": "2.0", "method": "discover", "id": "split"}) + "\n").encode()
+
+        self.s.send(request[:10])
+        time.sleep(0.1)
+        self.s.send(request[10:])
+
+        rjson = self.recv_lines(1)[0]
+        assert rjson['id'] == "split"
+
+    def test_batch_request(self):
+        batch = [{"jsonrpc": "2.0", "method": "discover", "id": i} for i in range(2)]
+
+        self.s.send((json.dumps(batch) + "\n").encode())
+
+        rjson = self.recv_lines(1)[0]
+        assert sorted(r['id'] for r in rjson) == [0, 1]
+
+
+class TestRPCErrors:
+    def test_error_responses(self):
+        response = JSONRPCResponseManager.handle(
+            '[{"jsonrpc": "2.0", "id": 1, "method": "stop_effect", "params": {}},'
+            ' {"jsonrpc": "2.0", "id": 2, "method": "get_color", "params": {"sid": 12345}}]', dispatcher)
+        errors = {r['id']: r['error']['code'] for r in json.loads(response.json)}
+        assert errors == {1: -32602, 2: -1003}
+
+    def test_invalid_effect(self):
+        for eid in (-1, True, 2, "0"):
+            response = JSONRPCResponseManager.handle(json.dumps(
+                {"jsonrpc": "2.0", "id": 1, "method": "start_effect", "params": {"sids": [1], "eid": eid, "eopt": {}}}
+            ), dispatcher)
+            assert json.loads(response.json)['error']['code'] == -1005
+
+    def test_invalid_rate(self):
+        for rate in (0, -1, "5", True, None):
+            response = JSONRPCResponseManager.handle(json.dumps(
+                {"jsonrpc": "2.0", "id": 1, "method": "subscribe", "params": {"rate": rate}}
+            ), dispatcher)
+            assert json.loads(response.json)['error']['code'] == -32602
+
+
+class TestController:
+    def test_skipped_writes(self):
+        c, bus = simulated_controller(90)
+        try:
+            with c.frame():
+                c.stage(0, 100)
+                c.stage(1, 200)
+            c.bus.flush()
+            assert bus.device(0x40).level(0) == 100 and bus.device(0x40).level(1) == 200
+            transactions = bus.transactions
+
+            # unchanged values are answered by the shadow registers
+            with c.frame():
+                c.stage(0, 100)
+                c.stage(1, 200)
+            c.bus.flush()
+            assert c.writes_skipped == 2
+            assert bus.transactions == transactions
+        finally:
+            c.close()
+
+    def test_block_writes(self):
+        c, bus = simulated_controller(91)
+        try:
+            transactions = bus.transactions
+            with c.frame():
+                for channel in range(10):
+                    c.stage(channel, 10 * channel + 1)
+            c.bus.flush()
+
+            # auto increment is on and the channels go out as 8 + 2 channels of 4 registers each
+            assert bus.device(0x40).registers[0x00] & MODE1_AI
+            assert bus.transactions - transactions == 2
+            assert [bus.device(0x40).level(channel) for channel in range(10)] == [10 * n + 1 for n in range(10)]
+        finally:
+            c.close()
+
+    def test_failed_write_invalidates_shadow(self):
+        c, bus = simulated_controller(92)
+        try:
+            c.set_all_channel(0.5)
+            assert c.get_level(3) == 2047 / 4095
+
+            def fail(*args):
+                raise OSError(5, "Input/output error")
+
+            bus.write_word_data = fail
+            try:
+                c.set_all_channel(1.0)
+                assert False
+            except OSError:
+                pass
+            assert c._shadow == {}
+
+            # the next write is not skipped, whatever the shadow held before
+            del bus.write_word_data
+            c.stage(3, 2047)
+            c.bus.flush()
+            assert c.writes_skipped == 0
+            assert bus.device(0x40).level(3) == 2047
+        finally:
+            c.close()
+
+    def test_probe_wakes_up(self):
+        simbus.install()
+        # 200 Hz is the power-on PRESCALE, the controller has to be woken up without reprogramming it
+        for device, frequency in ((88, 200), (89, 1526)):
+            c = Controller(channels=16, i2c_device=device, address="0x40", _pwm_freq=frequency)
+            try:
+                registers = simbus.buses[device].device(0x40).registers
+                assert not registers[0x00] & MODE1_SLEEP
+                assert registers[0xFE] == Controller.prescale(frequency)
+            finally:
+                c.close()
+
+    def test_failed_probe_releases_bus(self):
+        simbus.install()
+
+        def fail(*args):
+            raise OSError(121, "Remote I/O error")
+
+        read = SMBus.read_byte_data
+        SMBus.read_byte_data = fail
+        try:
+            Controller(channels=16, i2c_device=98, address="0x40", _pwm_freq=1526)
+            assert False
+        except OSError:
+            pass
+        finally:
+            SMBus.read_byte_data = read
+
+        # the worker of the bus is stopped, the next controller opens the device again
+        assert 98 not in i2cbus._buses
+        c, _ = simulated_controller(98)
+        try:
+            assert c.bus.users == 1
+            assert c.bus._error_handlers == {0x40: c._write_failed}
+        finally:
+            c.close()
+        assert c.bus._error_handlers == {}
+
+
+class TestI2CBus:
+    def test_coalesce(self):
+        c, bus = simulated_controller(93)
+        try:
+            transactions = bus.transactions
+            # while the worker is blocked, repeated writes of a register replace each other
+            with c.bus._io_lock:
+                for level in (1, 2, 3):
+                    c.bus.write_i2c_block_data(0x40, 0x08, [level, 0])
+            c.bus.flush()
+
+            assert bus.transactions - transactions == 1
+            assert bus.device(0x40).level(0) == 3
+            assert c.bus.coalesced == 4
+        finally:
+            c.close()
+
+    def test_failed_queued_write(self):
+        c, bus = simulated_controller(94)
+        other, _ = simulated_controller(94, "0x41")
+        try:
+            write = bus.write_i2c_block_data
+            failures = []
+
+            def fail(address, register, data):
+                if address == 0x40:
+                    failures.append(register)
+                    raise OSError(5, "Input/output error")
+                write(address, register, data)
+
+            bus.write_i2c_block_data = fail
+            with c.bus._io_lock:
+                with c.frame():
+                    for channel in range(12):
+                        c.stage(channel, 1000)
+                other.stage(0, 1000)
+            c.bus.flush()
+
+            # the remaining blocks to the failed address are dropped, the shadow is gone, other addresses are written
+            assert len(failures) == 1
+            assert c._shadow == {}
+            assert bus.device(0x41).level(0) == 1000
+        finally:
+            other.close()
+            c.close()
+
+    def test_failed_write_racing_set_all_channel(self):
+        c, bus = simulated_controller(99)
+        entered = threading.Event()
+        release = threading.Event()
+
+        def fail(address, register, data):
+            entered.set()
+            release.wait(1)
+            raise OSError(5, "Input/output error")
+
+        bus.write_i2c_block_data = fail
+        try:
+            c.stage(0, 1000)
+            assert entered.wait(1)
+
+            # set_all_channel holds the controller lock while it waits for the bus the worker still holds
+            setter = threading.Thread(target=c.set_all_channel, args=(0.5,))
+            setter.start()
+            time.sleep(0.05)
+            release.set()
+            setter.join(2)
+            assert not setter.is_alive()
+        finally:
+            release.set()
+            del bus.write_i2c_block_data
+            c.close()
+
+
+class TestUDPFrame:
+    def test_roundtrip(self):
+        seq, colors = decode_frame(encode_frame(42, [(1, (1.0, 0.5, 0.0)), (7, (0.0, 0.0, 0.25))]))
+
+        assert seq == 42
+        assert [sid for sid, _ in colors] == [1, 7]
+        assert all(abs(a - b) < 1e-4 for a, b in zip(colors[0][1] + colors[1][1], (1.0, 0.5, 0.0, 0.0, 0.0, 0.25)))
+
+    def test_invalid_frame(self):
+        for data in (b"", b"XX\x00\x00\x00\x01", encode_frame(1, [(1, (1, 1, 1))])[:-1]):
+            try:
+                decode_frame(data)
+            except ValueError:
+                pass
+            else:
+                assert False, data
+
+    def test_sequence_order(self):
+        assert is_newer(2, 1)
+        assert not is_newer(1, 2)
+        assert not is_newer(5, 5)
+        assert is_newer(3, 0xFFFFFFFE)
+        assert is_newer(0, 100)
+
+
+class TestPersistence:
+    def test_write_behind(self):
+        with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+            session.configure(bind=create_engine("sqlite:///" + f.name))
+            db = DBWorker(batch_delay=60)
+            db.call(Base.metadata.create_all, session.get_bind()).result()
+
+            db.submit(save_states, {1: ((0.5, 0.0, 1.0), None, None)})
+            db.submit(save_states, {2: (None, "FadeEffect", "{}")})
+            # both writes are visible to the db thread before they are committed
+            states = db.call(load_states).result()
+            assert states[1].color == (0.5, 0.0, 1.0)
+            assert states[2].effect == "FadeEffect"
+            assert db.commits == 0
+
+            db.close()
+            assert db.commits == 1
+
+            db = DBWorker()
+            assert set(db.call(load_states).result()) == {1, 2}
+            db.close()
+
+    def test_load_links(self):
+        with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+            engine = create_engine("sqlite:///" + f.name)
+            session.configure(bind=engine)
+            # load_db creates missing tables through the bound metadata, like the daemon
+            Base.metadata.bind = engine
+            db = DBWorker()
+            db.call(Base.metadata.create_all).result()
+
+            c, _ = simulated_controller(95)
+            c.id = 1
+            s = Stripe(id=1, name="a", rgb=True, channel_r=0, channel_g=1, channel_b=2, controller_id=c.id)
+            for instance in (Meta(option="db_version", value="4"), c, s):
+                db.submit(session.add, instance)
+            db.close()
+            c.close()
+
+            # links between controllers and stripes are plain attributes, set up in the db thread
+            db = DBWorker()
+            controllers = db.call(ledd.daemon.load_db).result()
+            db.close()
+            assert [stripe.id for stripe in controllers[0].stripes] == [1]
+            assert controllers[0].stripes[0].controller is controllers[0]
+            controllers[0].close()
+
+
+class TestSimBus:
+    def test_auto_increment(self):
+        bus = SMBus(99)
+        bus.write_i2c_block_data(0x40, 0x06, [0, 0, 0xFF, 0x0F])
+        # without auto increment every byte goes to LED0_ON_L
+        assert bus.device(0x40).level(0) == 0
+
+        bus.write_byte_data(0x40, 0x00, MODE1_AI)
+        bus.write_i2c_block_data(0x40, 0x06, [0, 0, 0xFF, 0x0F, 0, 0, 0x00, 0x08])
+        assert bus.device(0x40).level(0) == 4095
+        assert bus.device(0x40).level(1) == 2048
+        assert bus.read_i2c_block_data(0x40, 0x08, 2) == [0xFF, 0x0F]
+        assert bus.stats == {'transactions': 4, 'bytes_written': 17, 'bytes_read': 2}
+
+    def test_registers(self):
+        device = PCA9685()
+        device.write(0xFE, [3])
+        # PRESCALE only accepts writes while sleeping, which it does after power on
+        assert device.read(0xFE, 1) == [3]
+        device.write(0x00, [MODE1_AI])
+        device.write(0xFE, [5])
+        assert device.read(0xFE, 1) == [3]
+
+        device.write(0xFC, [0x34, 0x02])
+        assert all(device.level(channel) == 0x234 for channel in range(16))
+
+
+class TestProcessBus:
+    def test_coalesce(self):
+        bus = ProcessBus(98)
+        try:
+            bus.write_byte_data(0x40, 0x00, MODE1_AI)
+            for level in range(100):
+                bus.write_i2c_block_data(0x40, 0x06, [0, 0, level, 0])
+            bus.flush()
+            # only the newest frame has to reach the chip, older ones may be skipped
+            assert bus.read_i2c_block_data(0x40, 0x08, 2) == [99, 0]
+            assert bus.by_address[0x40]['transactions'] <= 100
+        finally:
+            bus.close()
+
+    def test_many_writes_between_snapshots(self):
+        bus = ProcessBus(97)
+        try:
+            bus.write_byte_data(0x40, 0x00, MODE1_AI)
+            bus.write_i2c_block_data(0x40, 0x06, [1])
+            bus.flush()
+
+            # the register is written 256 times while the worker does not look, e.g. on a stalled bus
+            offset = 0x40 * 256 + 0x06
+            with bus._lock:
+                bus._sequence.value += 1
+                bus._values[offset] = 2
+                bus._generations[offset] += 256
+                bus._sequence.value += 1
+                bus._doorbell.send_bytes(b"")
+            bus.flush()
+            assert bus.read_byte_data(0x40, 0x06) == 2
+        finally:
+            bus.close()
+
+
+class TestFrameBuffer:
+    def test_claimed_slots(self):
+        path = tempfile.mktemp()
+        framebuffer = FrameBuffer(path, 8)
+        try:
+            writer = FrameBufferWriter(path)
+            writer.write(3, (1.0, 0.0, 0.5))
+            framebuffer.claim(3, self)
+            assert writer.claimed(3)
+            # colors written before the claim are stale
+            assert framebuffer.poll() == []
+
+            writer.write(3, (0.0, 1.0, 0.0))
+            writer.write(4, (1.0, 1.0, 1.0))
+            assert framebuffer.poll() == [(3, (0.0, 1.0, 0.0))]
+            assert framebuffer.poll() == []
+
+            # a producer in the middle of a write
+            GENERATION.pack_into(writer._map, slot_offset(3), 5)
+            assert framebuffer.poll() == []
+            assert framebuffer.torn == 1
+
+            framebuffer.release_owner(self)
+            assert not writer.claimed(3)
+            writer.close()
+        finally:
+            framebuffer.close()
+
+
+class TestPixelStripe:
+    def test_show(self):
+        stripe = PixelStripe(id=1, pixels=2, output='loopback', order='grb', gamma=1.0)
+        stripe.open()
+        stripe.show(b"\x01\x02\x03\x04\x05\x06\x07")
+        assert stripe._output.frame == b"\x02\x01\x03\x05\x04\x06"
+
+    def test_rainbow(self):
+        stripes = [PixelStripe(id=1, pixels=6, output='loopback'), PixelStripe(id=2, pixels=3, output='loopback')]
+        stack = PixelStack(RainbowEffect({'length': 3}))
+        stack.stripes.extend(stripes)
+        first = stack.render()
+        second = stack.render()
+        assert len(first) == 18
+        assert first[:3] == b"\xff\x00\x00" and first[9:12] == b"\xff\x00\x00"
+        assert second[:-3] == first[3:]
+
+        stack.apply(second)
+        assert stripes[1].buffer == second[:9]
+
+
+class TestFrameTables:
+    def test_recorded_while_rendering(self):
+        class ShortFade(FadeEffect):
+            period = 4
+
+        scheduler = FrameScheduler(FakeLoop(), [], fps=10.0)
+        stack = EffectStack(ShortFade())
+        assert stack.table is None
+        frames = [scheduler.render([stack])[0][1] for _ in range(8)]
+
+        # after one period the stack plays the recorded rgb frames back, continuing where the live ones stopped
+        assert stack.table is not None and stack.color_space == RGB
+        assert all(abs(a - b) < 1e-6 for live, baked in zip(frames[:4], frames[4:]) for a, b in zip(live, baked))
+        assert EffectStack(ShortFade()).table is stack.table
+
+
+class TestModifiers:
+    def test_fuse(self):
+        house, stack = Modifiers(), Modifiers()
+        assert fuse(house, stack) is None
+
+        house.update(brightness=0.5)
+        stack.update(saturation=0.0)
+        r, g, b = transform(fuse(house, stack), (1.0, 0.0, 0.0))
+        assert abs(r - 0.1063) < 1e-9 and abs(g - 0.1063) < 1e-9 and abs(b - 0.1063) < 1e-9
+
+        try:
+            house.update(brightness=2)
+            assert False
+        except ValueError:
+            assert house.brightness == 0.5
+
+    def test_pixel_gains(self):
+        modifiers = Modifiers()
+        modifiers.update(brightness=0.5)
+        stripe = PixelStripe(id=1, pixels=1, output='loopback', gamma=1.0)
+        stripe.open()
+        stripe.show(b"\xff\x80\x00", modifiers.gains)
+        assert stripe._output.frame == b"\x80\x40\x00"
+
+        stripe.limit = 0.25
+        stripe.show(b"\xff\x80\x00", modifiers.gains)
+        assert stripe._output.frame == b"\x40\x40\x00"
+
+    def test_pixel_saturation(self):
+        scheduler = FrameScheduler(FakeLoop(), [], fps=10.0)
+        stack = PixelStack(None)
+        stripe = PixelStripe(id=1, pixels=1, output='loopback', gamma=1.0)
+        stripe.open()
+        stack.stripes.append(stripe)
+
+        # pixel stripes do not follow saturation, gray stays gray
+        for saturation in (0.0, 0.5, 2.0):
+            scheduler.modifiers.update(saturation=saturation)
+            scheduler.flush([(stack, b"\x80\x80\x80")])
+            assert stripe._output.frame == b"\x80\x80\x80"
+
+        scheduler.modifiers.update(brightness=0.5)
+        scheduler.flush([(stack, b"\x80\x80\x80")])
+        assert stripe._output.frame == b"\x40\x40\x40"
+
+
+class TestScheduler:
+    def test_broken_transition(self):
+        loop = FakeLoop()
+        scheduler = FrameScheduler(loop, [], fps=10.0)
+        good, bad = Target(), Target()
+        scheduler.fade('good', good, (0.0,), (1.0,), 1.0)
+        scheduler.fade('bad', bad, (0.0,), ("abc",), 1.0)
+        loop.run_until(0.55)
+
+        # the broken transition is dropped, the other one keeps running
+        assert 'bad' not in scheduler.transitions
+        assert len(good.values) == 6 and scheduler.running
+
+    def test_broken_render(self):
+        class Broken(Target):
+            def render(self):
+                raise ValueError("broken effect")
+
+        loop = FakeLoop()
+        scheduler = FrameScheduler(loop, [], fps=10.0)
+        scheduler.add(Broken())
+        loop.run_until(0.55)
+
+        # the failed frames are logged, the clock keeps its deadlines
+        assert scheduler.running and scheduler.frames == 6
+
+    def test_broken_controller(self):
+        broken = FakeController(1, OSError(errno.EREMOTEIO, "Remote I/O error"))
+        healthy = FakeController(2)
+        scheduler = FrameScheduler(FakeLoop(), [broken, healthy], fps=10.0)
+        for _ in range(3):
+            scheduler.flush([])
+
+        # controllers after the failing one are still committed and never stay in an open frame
+        assert healthy.commits == 3 and healthy.depth == 0 and broken.depth == 0
+
+    def test_deadlines(self):
+        loop = FakeLoop()
+        scheduler = FrameScheduler(loop, [], fps=10.0)
+        stack = Target()
+        scheduler.add(stack)
+        loop.run_until(0.95)
+        assert scheduler.frames == 10 and scheduler.overruns == 0
+
+        # the clock stops by itself once there is nothing to render
+        scheduler.remove(stack)
+        loop.run_until(1.5)
+        assert not scheduler.running and scheduler.frames == 10
+
+    def test_overrun(self):
+        loop = FakeLoop()
+        scheduler = FrameScheduler(loop, [], fps=10.0)
+        scheduler.add(Target(loop, 0.25))
+        loop.run_until(0.0)
+
+        # a frame taking 2.5 periods skips the two ticks it missed, the next one stays on the grid
+        assert scheduler.frames == 1 and scheduler.overruns == 2
+        pending = [h.when for h in loop.handles if not h.cancelled]
+        assert len(pending) == 1 and abs(pending[0] - 0.3) < 1e-9
+        scheduler.stop()
+
+    def test_double_buffer(self):
+        loop = FakeLoop()
+        scheduler = FrameScheduler(loop, [], fps=10.0, workers=True)
+        target = Target()
+        try:
+            frames = []
+            for value in (1, 2, 3):
+                future = Future()
+                future.set_result([(target, (value,))])
+                frames.append(future)
+
+            scheduler._rendered(frames[0])
+            # frames rendered while one is flushed wait, a newer one replaces the waiting one
+            scheduler._rendered(frames[1])
+            scheduler._rendered(frames[2])
+            assert scheduler.overruns == 1
+
+            while scheduler._flushing is not None or scheduler._next_frame is not None:
+                if scheduler._flushing is not None:
+                    scheduler._flushing.result(1)
+                loop.run_until(loop.now)
+            assert target.values == [(1,), (3,)]
+        finally:
+            scheduler.stop()
+
+
+class TestStats:
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        assert histogram.cumulative() == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+        assert histogram.count == 4
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        timed = metrics.timed('rpc_seconds', lambda: 42, method='get')
+        assert timed() == 42
+        metrics.collectors.append(lambda: [('frames_total', {}, 7)])
+
+        text = metrics.prometheus()
+        assert 'rpc_seconds_count{method="get"} 1' in text
+        assert 'rpc_seconds_bucket{method="get",le="+Inf"} 1' in text
+        assert '# TYPE frames_total counter\nframes_total 7\n' in text
+
+
+class TestProfiling:
+    def test_sampling(self):
+        stack = EffectStack()
+        idle = threading.Event()
+        waiter = threading.Thread(target=idle.wait)
+        waiter.start()
+        session = profiling.start(profiling.SAMPLING, 10, 0.001)
+        try:
+            started = time.monotonic()
+            while time.monotonic() - started < 0.1:
+                stack.render()
+        finally:
+            assert profiling.stop() is session
+            idle.set()
+            waiter.join()
+
+        assert profiling.session is None
+        assert session.samples > 0
+        summary = session.summary(5)
+        assert not summary['running']
+        assert summary['effects'][0]['effect'] == 'FadeEffect'
+        assert len(summary['top']) <= 5
+
+        # the waiting thread is sampled in every tick, times are not divided by the number of threads
+        waited = max(entry['self'] for entry in session.top(50, 'self') if entry['function'].endswith('(wait)'))
+        assert waited > 0.5 * session.elapsed
+
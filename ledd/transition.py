@@ -0,0 +1,56 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+EASINGS = {
+    'linear': lambda t: t,
+    'ease_in': lambda t: t * t,
+    'ease_out': lambda t: t * (2.0 - t),
+    'ease_in_out': lambda t: t * t * (3.0 - 2.0 * t),
+}
+
+
+class Transition(object):
+    """
+    Interpolates a tuple of values from start to end over duration seconds of loop time.
+    The target receives the values with every frame, see FrameScheduler.fade.
+    """
+    __slots__ = ('target', 'start', 'end', 'begin', 'duration', 'easing')
+
+    def __init__(self, target, start, end, begin, duration, easing='linear'):
+        """
+        :param target: frame entry with an apply(values) method and the affected stripes
+        :param begin: loop time the transition starts at
+        :raises KeyError: for unknown easings
+        """
+        self.target = target
+        self.start = tuple(start)
+        self.end = tuple(end)
+        self.begin = begin
+        self.duration = duration
+        self.easing = EASINGS[easing]
+
+    def at(self, now):
+        """
+        :return: the values at loop time now
+        """
+        if self.duration <= 0 or now >= self.begin + self.duration:
+            return self.end
+
+        t = self.easing(max(now - self.begin, 0.0) / self.duration)
+        return tuple(a + (b - a) * t for a, b in zip(self.start, self.end))
+
+    def done(self, now):
+        return now >= self.begin + self.duration
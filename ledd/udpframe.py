@@ -0,0 +1,69 @@
+# LEDD Project
+# Copyright (C) 2015 LEDD Team
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary frame format for the UDP listener.
+
+A datagram starts with the magic b"LD" and a 32 bit sequence number, followed by any number of entries of a 16 bit
+stripe id and 16 bit red, green and blue values. All numbers are unsigned and big endian.
+"""
+
+import struct
+
+MAGIC = b"LD"
+HEADER = struct.Struct(">2sI")
+ENTRY = struct.Struct(">HHHH")
+MAXVAL = 0xFFFF
+
+
+def encode_frame(seq, colors):
+    """
+    :param seq: sequence number, increased by one for every frame
+    :param colors: iterable of (stripe id, (r, g, b)) with components in [0, 1]
+    :rtype: bytes
+    """
+    data = bytearray(HEADER.pack(MAGIC, seq & 0xFFFFFFFF))
+    for sid, rgb in colors:
+        data += ENTRY.pack(sid, *(int(min(max(c, 0.0), 1.0) * MAXVAL + 0.5) for c in rgb))
+    return bytes(data)
+
+
+def decode_frame(data):
+    """
+    :return: sequence number and list of (stripe id, (r, g, b)) with components in [0, 1]
+    :raises ValueError: if data is not a valid frame
+    """
+    if len(data) < HEADER.size or (len(data) - HEADER.size) % ENTRY.size:
+        raise ValueError("Invalid frame length: {}".format(len(data)))
+
+    magic, seq = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Invalid frame magic: {!r}".format(magic))
+
+    colors = []
+    for offset in range(HEADER.size, len(data), ENTRY.size):
+        sid, r, g, b = ENTRY.unpack_from(data, offset)
+        colors.append((sid, (r / MAXVAL, g / MAXVAL, b / MAXVAL)))
+
+    return seq, colors
+
+
+def is_newer(seq, last):
+    """
+    Compares sequence numbers with wrap around. A sequence number of 0 is always accepted, so restarted senders
+    are picked up again.
+    """
+    return seq == 0 or 0 < (seq - last) & 0xFFFFFFFF < 0x80000000